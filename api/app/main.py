@@ -1,42 +1,248 @@
 from fastapi import FastAPI, HTTPException, Body  # Add Body import
-from source.indexing.indexing_manager import IndexingManager
-from source.chatter.conversation_manager import ConversationManager, AsyncModelManager, generate_response
-from source.indexing.indexing_tree import sanitize_url
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from source.indexing.index_registry import IndexRegistry
+from source.indexing.jobs import JobManager
+from source.chatter.conversation_manager import (ConversationManager, generate_response, stream_response, streaming_stats,
+                                                 embed_query, retrieve_context, query_batcher)
+from source.chatter.answer_cache import AnswerCache
+from source.chatter.model_pool import ModelPool, PoolExhaustedError
+from source.telemetry import (InstrumentedExecutor, TracingMiddleware, configure_trace_log, metrics_registry,
+                              stats_gauges)
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import List
+import asyncio
+import json
 import os
 import logging
+import time
 
-app = FastAPI()
-active_indexes = {}
+model_pool = ModelPool.from_env()
+configure_trace_log(os.getenv("TRACE_LOG"))  # JSON span lines to stderr ("1") or to a file
+# Progress of `preload`, reported by /health/ready
+warmup = {"status": "pending", "error": None, "seconds": None, "indexes": {}}
+
+async def preload():
+    """Load and warm the LLM pool, the embedding model and the PRELOAD_URLS indexes"""
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    warmup["status"] = "running"
+
+    async def warm_retrieval():
+        from source.indexing.embedder import get_model  # Not an EmbeddingManager: it creates index directories
+        await loop.run_in_executor(None, lambda: get_model().embed_query("warmup"))
+        for url in filter(None, (url.strip() for url in os.getenv("PRELOAD_URLS", "").split(","))):
+            warmup["indexes"][url] = await index_registry.get(url) is not None
+
+    try:
+        await asyncio.gather(model_pool.start(), warm_retrieval())
+    except Exception as e:
+        warmup.update(status="failed", error=str(e))
+        print(f"Preload failed: {e}")
+        return
+    warmup.update(status="done", seconds=round(time.perf_counter() - start_time, 1))
+    print(f"Preload done in {warmup['seconds']}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # run_in_executor(None, ...) calls go through an executor that reports its saturation
+    asyncio.get_running_loop().set_default_executor(
+        InstrumentedExecutor("default", max_workers=min(32, (os.cpu_count() or 1) + 4))
+    )
+    # Models load in the background while the worker already serves requests: health checks
+    # answer at once and early questions wait for the pool. PRELOAD=0 loads on first use instead.
+    preload_task = None
+    if os.getenv("PRELOAD", "1") != "0":
+        preload_task = asyncio.create_task(preload())
+    else:
+        warmup["status"] = "skipped"
+    yield
+    if preload_task is not None:
+        preload_task.cancel()
+    job_manager.shutdown()
+    await model_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(TracingMiddleware)
+index_registry = IndexRegistry.from_env()
+job_manager = JobManager.from_env()
+job_manager.on_finished = index_registry.register  # Other workers see it through the on-disk manifest
+answer_cache = AnswerCache.from_env()
+metrics_registry.register_collector(lambda: [
+    *stats_gauges("rag_pool", {key: value for key, value in model_pool.stats().items() if key != "waiting_per_user"}),
+    *stats_gauges("rag_streaming", streaming_stats()),
+    *stats_gauges("rag_index_registry", index_registry.stats()),
+    *stats_gauges("rag_query_batcher", query_batcher.stats()),
+    *stats_gauges("rag_answer_cache", answer_cache.stats()),
+])
 
 @app.post("/process_url")
-async def process_url(url: str = Body(..., embed=True)): 
-    manager = IndexingManager(url)
-    await manager()  # Initialize the manager by running the pipeline
-    active_indexes[manager.sanitized_url] = manager   # Store the manager instance
+async def process_url(url: str = Body(..., embed=True), rebuild: bool = Body(False, embed=True),
+    wait: bool = Body(False, embed=True)     # Block until the index is built (old behaviour)
+):
+    # Indexing runs in the background; the same URL is never crawled twice concurrently
+    job = job_manager.submit(url, rebuild=rebuild)
+    if not wait:
+        return job
+    await job_manager.wait(url)
+    job = job_manager.status(url)
+    if job["status"] != "done":
+        raise HTTPException(500, job.get("error") or f"Indexing {job['status']}")
     return {"status": "index_created"}
 
+@app.get("/process_url/status")
+async def process_url_status(url: str):
+    job = job_manager.status(url)
+    if job is None:
+        raise HTTPException(404, "No indexing job for this URL")
+    return job
+
 @app.post("/ask")
 async def ask_question( url: str = Body(..., embed=True),        # Parse from JSON
     query: str = Body(..., embed=True),      # All parameters must be
-    user_id: str = Body(..., embed=True)     # wrapped with Body()
+    user_id: str = Body(..., embed=True),    # wrapped with Body()
+    stream: bool = Body(False, embed=True)   # Send tokens as server-sent events
 ):
-    sanitized_url = sanitize_url(url)  # Sanitize before checking):
-    if sanitized_url not in active_indexes:
+    # Loaded lazily from disk, so indexes built by another worker or before a restart work too
+    manager = await index_registry.get(url)
+    if manager is None:
         raise HTTPException(418, "URL not indexed")
     
-    manager = active_indexes[sanitized_url]  # Use sanitized key
     conv_manager = ConversationManager(url, user_id)
     conv_manager.index_manager = manager  # Link the IndexingManager
     await conv_manager.initialize()
-    logging.info("Conversation context built, starting to load model...")
-    # Initialize Model
-    model_mgr = AsyncModelManager()
-    model = await model_mgr.load_model()
-    logging.info("Model loaded, starting to answer the question...")
-    # Generate response
-    response = await generate_response(model, conv_manager, query)
+    # Answers only depend on the question while no history goes into the prompt
+    query_vector = await embed_query(conv_manager, query)
+    cache_key = None
+    if not conv_manager.recent_history():
+        cache_key = (conv_manager.sanitized_url, index_registry.version(url))
+        response = answer_cache.lookup(*cache_key, query_vector)
+        if response is not None:
+            logging.info("Answered from the answer cache")
+            await conv_manager.add_interaction(query, response)
+            if stream:
+                return StreamingResponse(iter([
+                    f"data: {json.dumps({'token': response})}\n\n",
+                    f"data: {json.dumps({'done': True})}\n\n",
+                ]), media_type="text/event-stream")
+            return {"response": response}
+
+    logging.info("Conversation context built, waiting for a model...")
+    if stream:
+        return await stream_answer(conv_manager, query, user_id, query_vector, cache_key)
+    try:
+        async with model_pool.lease(user_id) as model:
+            logging.info("Model leased, starting to answer the question...")
+            response = await generate_response(model, conv_manager, query, query_vector=query_vector)
+    except PoolExhaustedError as e:
+        raise HTTPException(503, str(e))
+    if cache_key is not None:
+        answer_cache.store(*cache_key, query_vector, response)
     
     # Save interaction
     await conv_manager.add_interaction(query, response)  # This saves automatically
     
-    return {"response": response}
\ No newline at end of file
+    return {"response": response}
+
+@app.post("/ask_batch")
+async def ask_batch(url: str = Body(..., embed=True),
+    queries: List[str] = Body(..., embed=True),
+    user_id: str = Body("batch", embed=True)
+):
+    """Answer many independent questions (no history, nothing saved), e.g. for evaluation runs"""
+    manager = await index_registry.get(url)
+    if manager is None:
+        raise HTTPException(418, "URL not indexed")
+    conv_manager = ConversationManager(url, user_id)
+    conv_manager.index_manager = manager
+
+    # Retrieval for every question runs as a few batched embedding/search calls
+    contexts = await asyncio.gather(*(retrieve_context(conv_manager, query) for query in queries))
+    responses = []
+    for query, context in zip(queries, contexts):
+        # One lease per question at low priority, so interactive users are not starved
+        try:
+            async with model_pool.lease(user_id, priority=-1) as model:
+                responses.append(await generate_response(
+                    model, conv_manager, query, use_history=False, context=context
+                ))
+        except PoolExhaustedError as e:
+            raise HTTPException(503, str(e))
+    return {"responses": responses}
+
+class LeasedStreamingResponse(StreamingResponse):
+    """StreamingResponse that returns its model lease even when the body is never iterated,
+    e.g. when the client disconnects before the response starts"""
+
+    def __init__(self, content, lease, **kwargs):
+        super().__init__(content, **kwargs)
+        self.lease = lease
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Closing the body first stops generation; the lease is then released once
+            await self.body_iterator.aclose()
+            await self.lease.aclose()
+
+async def stream_answer(conv_manager, query, user_id, query_vector, cache_key=None):
+    """Answer as a text/event-stream of `{"token": ...}` events ending with `{"done": true}`"""
+    # Lease before responding so a busy pool is still reported as a 503
+    lease = AsyncExitStack()
+    try:
+        model = await lease.enter_async_context(model_pool.lease(user_id))
+    except PoolExhaustedError as e:
+        raise HTTPException(503, str(e))
+
+    async def events():
+        # The model stays leased for the whole stream; if the client goes away the
+        # generator is closed, generation stops and the model is returned early
+        async with lease:
+            tokens = []
+            try:
+                async for token in stream_response(model, conv_manager, query, query_vector=query_vector):
+                    tokens.append(token)
+                    yield f"data: {json.dumps({'token': token})}\n\n"
+            except Exception as e:
+                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                return
+        response = "".join(tokens)
+        if cache_key is not None:
+            answer_cache.store(*cache_key, query_vector, response)
+        await conv_manager.add_interaction(query, response)
+        yield f"data: {json.dumps({'done': True})}\n\n"
+
+    return LeasedStreamingResponse(events(), lease, media_type="text/event-stream")
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness: the worker's event loop is responding"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: 200 once the preload is done, 503 while it runs or after it failed"""
+    ready = warmup["status"] in ("done", "skipped")
+    return JSONResponse({
+        "ready": ready,
+        "warmup": warmup,
+        "model_loaded": model_pool.ready,
+        "indexes_loaded": index_registry.stats()["loaded"],
+    }, status_code=200 if ready else 503)
+
+@app.get("/pool_stats")
+async def pool_stats():
+    return {**model_pool.stats(), "streaming": streaming_stats()}
+
+@app.get("/index_stats")
+async def index_stats():
+    return {**index_registry.stats(), "query_batcher": query_batcher.stats()}
+
+@app.get("/answer_cache_stats")
+async def answer_cache_stats():
+    return answer_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of this worker's counters, histograms and stats"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
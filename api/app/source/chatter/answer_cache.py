@@ -0,0 +1,108 @@
+import os
+import time
+import numpy as np
+from collections import OrderedDict
+
+
+class _SiteAnswers:
+    """Cached answers for one indexed site, valid for one version of its index."""
+
+    def __init__(self, version, dimension):
+        self.version = version
+        self.vectors = np.zeros((0, dimension), dtype=np.float32)
+        self.answers = []
+        self.created = np.zeros(0)
+        self.last_used = np.zeros(0)
+
+    def keep(self, mask):
+        self.vectors = self.vectors[mask]
+        self.answers = [answer for answer, ok in zip(self.answers, mask) if ok]
+        self.created = self.created[mask]
+        self.last_used = self.last_used[mask]
+
+
+class AnswerCache:
+    """Answers to earlier questions, found again by query embedding similarity.
+
+    Entries are kept per sanitized URL together with the version of the index
+    they were generated from (the manifest mtime), so a rebuilt index starts
+    with an empty cache. Query embeddings are normalized, so the inner product
+    is the cosine similarity; a question is answered from the cache when it is
+    at least `threshold` similar to a cached one. Entries expire after `ttl`
+    seconds and each site keeps at most `max_entries`, dropping the least
+    recently used.
+    """
+
+    def __init__(self, threshold=0.95, ttl=24 * 3600, max_entries=256, max_sites=64):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_sites = max_sites
+        self._sites = OrderedDict()  # sanitized_url -> _SiteAnswers
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600))),
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256")),
+        )
+
+    def _site(self, sanitized_url, version, dimension):
+        site = self._sites.get(sanitized_url)
+        if site is not None and site.version != version:
+            self.invalidations += 1
+            site = None
+        if site is None:
+            site = _SiteAnswers(version, dimension)
+            self._sites[sanitized_url] = site
+            while len(self._sites) > self.max_sites:
+                self._sites.popitem(last=False)
+        self._sites.move_to_end(sanitized_url)
+        return site
+
+    def lookup(self, sanitized_url, version, query_vector):
+        """Cached answer for a question similar enough to `query_vector`, or None"""
+        query_vector = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        site = self._site(sanitized_url, version, len(query_vector))
+        now = time.time()
+        if len(site.answers):
+            site.keep(site.created > now - self.ttl)
+        if len(site.answers):
+            similarities = site.vectors @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                site.last_used[best] = now
+                self.hits += 1
+                return site.answers[best]
+        self.misses += 1
+        return None
+
+    def store(self, sanitized_url, version, query_vector, answer):
+        if not answer or not answer.strip():
+            return
+        query_vector = np.asarray(query_vector, dtype=np.float32).reshape(1, -1)
+        site = self._site(sanitized_url, version, query_vector.shape[1])
+        now = time.time()
+        site.vectors = np.vstack([site.vectors, query_vector])
+        site.answers.append(answer)
+        site.created = np.append(site.created, now)
+        site.last_used = np.append(site.last_used, now)
+        if len(site.answers) > self.max_entries:
+            keep = np.zeros(len(site.answers), dtype=bool)
+            keep[np.argsort(site.last_used, kind="stable")[-self.max_entries:]] = True
+            site.keep(keep)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "sites": len(self._sites),
+            "entries": sum(len(site.answers) for site in self._sites.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,114 @@
+import numpy as np
+
+
+PROMPT_TEMPLATE = """<s>[INST] <<SYS>>
+        {instructions}
+        <</SYS>>
+
+        Previous conversation:
+        {history}
+        {context}
+
+        Please provide a comprehensive answer. [/INST]"""
+
+
+def mmr_order(query_vector, vectors, diversity=0.3, duplicate_similarity=0.95):
+    """Order candidates by maximal marginal relevance, dropping near-duplicates.
+
+    Each step picks the candidate maximizing
+    `(1 - diversity) * sim(query, c) - diversity * max sim(c, picked)`.
+    Vectors are normalized, so inner products are cosine similarities.
+    """
+    if len(vectors) == 0:
+        return []
+    relevance = vectors @ query_vector
+    pairwise = vectors @ vectors.T
+    remaining = list(range(len(vectors)))
+    picked = []
+    while remaining:
+        if picked:
+            redundancy = pairwise[np.ix_(remaining, picked)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = (1 - diversity) * relevance[remaining] - diversity * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+        if picked and pairwise[best, picked].max() >= duplicate_similarity:
+            continue
+        picked.append(best)
+    return picked
+
+
+class PromptBuilder:
+    """Packs instructions, history and retrieved chunks into the model's context window.
+
+    Tokens are counted with the model's own tokenizer. The answer keeps
+    `max_new_tokens` of the `n_ctx` window; instructions and the question always
+    go in, history may use up to `history_share` of what is left (oldest turns
+    are dropped first, a single long turn is truncated), and chunks fill the
+    rest in MMR order.
+    """
+
+    def __init__(self, tokenize, detokenize, n_ctx=2048, max_new_tokens=512, history_share=0.3,
+                 template_margin=32):
+        self.tokenize = tokenize
+        self.detokenize = detokenize
+        self.n_ctx = n_ctx
+        self.max_new_tokens = max_new_tokens
+        self.history_share = history_share
+        self.template_margin = template_margin  # Chat template tokens and tokenization drift
+
+    @classmethod
+    def for_model(cls, model, max_new_tokens=512):
+        return cls(
+            tokenize=lambda text: model.tokenize(text.encode("utf-8"), add_bos=False, special=True),
+            detokenize=lambda tokens: model.detokenize(tokens).decode("utf-8", errors="ignore"),
+            n_ctx=model.n_ctx(),
+            max_new_tokens=max_new_tokens,
+        )
+
+    def count(self, text):
+        return len(self.tokenize(text))
+
+    def truncate(self, text, max_tokens):
+        tokens = self.tokenize(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.detokenize(tokens[:max(0, max_tokens)]) + "..."
+
+    def _pack_history(self, history, budget):
+        """Most recent turns that fit in `budget` tokens, in chronological order"""
+        turns = []
+        for query, answer in reversed(history):
+            turn = f"User: {query}\nAssistant: {answer}"
+            cost = self.count(turn) + 1
+            if cost > budget:
+                if not turns and budget > 32:
+                    turns.append(self.truncate(turn, budget - 1))
+                break
+            turns.append(turn)
+            budget -= cost
+        return "\n".join(reversed(turns))
+
+    def build(self, instructions, question, chunks, chunk_vectors, query_vector, history=()):
+        """Full prompt with as much history and context as the budget allows.
+
+        `chunks` are already formatted context lines and `question` the
+        formatted question, which closes the context part of the prompt.
+        """
+        fixed = PROMPT_TEMPLATE.format(instructions=instructions, history="", context=question)
+        budget = self.n_ctx - self.max_new_tokens - self.template_margin - self.count(fixed)
+
+        history_str = self._pack_history(list(history), int(max(0, budget) * self.history_share))
+        budget -= self.count(history_str)
+
+        selected = []
+        for i in mmr_order(query_vector, chunk_vectors):
+            cost = self.count(chunks[i])
+            if cost <= budget:
+                selected.append(chunks[i])
+                budget -= cost
+        return PROMPT_TEMPLATE.format(
+            instructions=instructions,
+            history=history_str,
+            context="".join(selected) + question,
+        )
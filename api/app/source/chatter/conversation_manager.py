@@ -1,18 +1,45 @@
-import aiofiles
+from __future__ import annotations
+import contextlib
+import fcntl
 import json
+import os
+import numpy as np
 from pathlib import Path
-from typing import List, Tuple
-from llama_cpp import Llama
+from typing import TYPE_CHECKING, List, Tuple
 from ..indexing.indexing_tree import sanitize_url
+from ..indexing.query_batcher import QueryBatcher
+from .build_prompt import PromptBuilder
+from ..telemetry import TTFT_SECONDS, record_generation, record_span, span, traced
+import anyio
 import asyncio
+import math
+import threading
+import time
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama  # Imported when a model is loaded; it takes seconds
 
 class ConversationManager:
-    def __init__(self, url: str, user: str = "default"):
+    """History of one user's conversation about one site.
+
+    Turns are appended to `conversations.jsonl`, one JSON object per line, so
+    saving a turn writes only that turn. Loading reads just the tail of the
+    file, enough for the last `keep_turns` turns. Once the log grows past
+    `max_bytes` it is compacted to its last `compact_turns` turns.
+    """
+
+    def __init__(self, url: str, user: str = "default", keep_turns: int = 4,
+                 max_bytes: int = 1024 ** 2, compact_turns: int = 100):
         self.url = url
         self.user = user
         self.sanitized_url = sanitize_url(url)
         self.base_path = Path("data") / "websites" / self.sanitized_url / user
-        self.history = []
+        self.log_path = self.base_path / "conversations.jsonl"
+        self.keep_turns = keep_turns
+        self.max_bytes = max_bytes
+        self.compact_turns = compact_turns
+        self.history = []  # Last `keep_turns` (query, response) pairs
+        self.turns_total = 0
         self.index_manager = None  # To be set externally
 
     async def initialize(self):
@@ -26,48 +53,124 @@ class ConversationManager:
         await loop.run_in_executor(None, self.base_path.mkdir, 0o755, True, True)
 
     async def _load_history(self):
-        """Load conversation history from file"""
-        history_path = self.base_path / "conversations.json"
+        """Load the last turns of the conversation log"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._migrate_legacy_history)
+        records = await loop.run_in_executor(None, self._read_tail, self.keep_turns)
+        self.history = [(record["query"], record["response"]) for record in records]
+        self.turns_total = records[-1]["turn"] + 1 if records else 0
+
+    def _read_tail(self, turns):
+        """Last `turns` records of the log, reading backwards from the end of the file"""
         try:
-            async with aiofiles.open(history_path, "r") as f:
-                content = await f.read()
-                self.history = json.loads(content)
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.history = []
-
-    async def save_conversation(self):
-        """Save conversation history to file"""
-        history_path = self.base_path / "conversations.json"
-        async with aiofiles.open(history_path, "w") as f:
-            await f.write(json.dumps(self.history, indent=2))
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= turns:
+                step = min(64 * 1024, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        records = []
+        for line in data.splitlines()[-turns:]:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # Partial line left by a crash
+        return records
+
+    def _migrate_legacy_history(self):
+        """Convert the old whole-file conversations.json once"""
+        legacy_path = self.base_path / "conversations.json"
+        if self.log_path.exists() or not legacy_path.exists():
+            return
+        with self._locked():
+            # Another worker or request may have converted it while we waited for the lock
+            if self.log_path.exists() or not legacy_path.exists():
+                return
+            try:
+                history = json.loads(legacy_path.read_text())
+            except json.JSONDecodeError:
+                history = []
+            self._rewrite([self._record(turn, query, response) for turn, (query, response) in enumerate(history)])
+            legacy_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _record(turn, query, response):
+        return {"turn": turn, "time": time.time(), "query": query, "response": response}
+
+    def _rewrite(self, records):
+        tmp_path = self.log_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        os.replace(tmp_path, self.log_path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive lock on the log, shared by every worker writing to it"""
+        with open(self.base_path / "conversations.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _append(self, record):
+        """Append one record under an exclusive lock, compacting the log when it is too big"""
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._locked():
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size > self.max_bytes:
+                self._rewrite(self._read_tail(self.compact_turns))
 
     async def add_interaction(self, query: str, response: str):
         """Add and save an interaction asynchronously"""
-        self.history.append((query, response))
-        await self.save_conversation()
+        record = self._record(self.turns_total, query, response)
+        self.history = (self.history + [(query, response)])[-self.keep_turns:]
+        self.turns_total += 1
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._append, record)
+
+    def recent_history(self, max_turns: int = 3):
+        """The turns that go into the prompt (see `history_window`)"""
+        return history_window(self.history, max_turns, self.turns_total)
 
 class AsyncModelManager:
-    def __init__(self, model_name: str = "mistral/mistral-7b-instruct-v0.1.Q4_K_M.gguf"):
+    def __init__(self, model_name: str = "mistral/mistral-7b-instruct-v0.1.Q4_K_M.gguf", n_threads: int = 12,
+                 prompt_cache_bytes: int = 0):
         self.model_name = model_name
+        self.n_threads = n_threads
+        self.prompt_cache_bytes = prompt_cache_bytes  # 0 disables prompt prefix caching
         self.model_path = Path("data") / "models" / model_name
         self.llm = None
 
+    @traced("llm.load")
     async def load_model(self):
         """Load model with async wrapper"""
         loop = asyncio.get_event_loop()
         if not self.llm:
+            from llama_cpp import Llama
+            from .prompt_cache import PromptCache
             self.llm = await loop.run_in_executor(
                 None, 
                 lambda: Llama(
                     model_path=str(self.model_path),
                     n_ctx=2048,
-                    n_threads=12,
+                    n_threads=self.n_threads,
                     verbose=False,
                     use_mlock=True,
                     use_mmap=True,
                     seed = 42
                 )
             )
+            if self.prompt_cache_bytes:
+                self.llm.set_cache(PromptCache(self.prompt_cache_bytes))
         return self.llm
 
     async def _model_exists(self):
@@ -80,59 +183,189 @@ class AsyncModelManager:
         if hasattr(self, 'index_manager'):
             await self.index_manager.close()
 
-async def generate_response(
-    model: Llama,
+MAX_NEW_TOKENS = 512  # Generation budget kept free in the context window
+PROMPT_CANDIDATES = 10  # Chunks retrieved for the prompt builder to choose from
+
+# Query embedding and index search batched across concurrent requests
+query_batcher = QueryBatcher()
+
+# Time-to-first-token of streamed answers, in seconds
+streaming_metrics = {"streams": 0, "cancelled": 0, "ttft_seconds_total": 0.0, "ttft_seconds_max": 0.0}
+
+async def embed_query(conv_manager: ConversationManager, query: str):
+    """Embedding of the question, shared by the answer cache and the index search"""
+    return await query_batcher.embed(conv_manager.index_manager.embedding_manager, query)
+
+async def retrieve_context(
     conv_manager: ConversationManager,
     query: str,
-    temperature: float = 0.2,
-    use_history = True
+    query_vector = None
+):
+    """Candidate (chunk, source) pairs for the prompt and the query embedding"""
+    embedding_manager = conv_manager.index_manager.embedding_manager
+    if query_vector is None:
+        query_vector = await embed_query(conv_manager, query)
+    
+    # Batched with concurrent questions; more candidates than fit,
+    # so the prompt builder can pick a diverse subset
+    with span("retrieve"):
+        _, context_chunks, sources = await query_batcher.search(
+            embedding_manager, query, PROMPT_CANDIDATES, query_vector
+        )
+    found = [(chunk, source) for chunk, source in zip(context_chunks[0], sources[0]) if source is not None]
+    return found, query_vector
+
+async def build_full_prompt(
+    conv_manager: ConversationManager,
+    query: str,
+    use_history = True,
+    query_vector = None,
+    model: Llama = None,
+    context = None
 ) -> str:
-    """Generate response using context from IndexingManager"""
-    # Get context from IndexingManager
+    """Pack the full prompt sent to the model into its context window.
+
+    `context` is the result of `retrieve_context`, which is called here if not given.
+    """
     loop = asyncio.get_event_loop()
-    
-    # Run synchronous FAISS search in executor
-    search_results = await loop.run_in_executor(
-        None,
-        conv_manager.index_manager.embedding_manager.search_index,
-        [query],
-        5
-    )
-    
-    # Unpack results
-    _, context_chunks = search_results
-    
-    # Build prompt using IndexingManager's logic
-    prompt = conv_manager.index_manager.build_starting_prompt(context_chunks[0], query)
-    
-    # Add conversation history
-    if use_history:
-        
-        history_str = "\n".join(
-            [f"User: {q}\nAssistant: {a}" for q, a in conv_manager.history[-3:]]
+    index_manager = conv_manager.index_manager
+    embedding_manager = index_manager.embedding_manager
+    found, query_vector = context or await retrieve_context(conv_manager, query, query_vector)
+
+    def build():
+        vectors = embedding_manager.chunk_vectors([source["id"] for _, source in found],
+                                                  [chunk for chunk, _ in found])
+        # Stable parts come first so llama.cpp can reuse the evaluated prefix
+        # (instructions, then history) and only evaluate the context and question
+        return PromptBuilder.for_model(model, MAX_NEW_TOKENS).build(
+            index_manager.BASE_PROMPT,
+            index_manager.format_question(query),
+            [index_manager.format_chunk(chunk, source) for chunk, source in found],
+            vectors,
+            np.asarray(query_vector, dtype=np.float32).reshape(-1),
+            conv_manager.recent_history() if use_history else (),
         )
-    else:
-        history_str = ""
 
-    full_prompt = f"""<s>[INST] <<SYS>>
-        {prompt}
-        <</SYS>>
+    return await loop.run_in_executor(None, build)
+
+def history_window(history, max_turns: int = 3, total: int = None):
+    """Last 2..`max_turns` turns of the history, with a start that only moves every other turn.
 
-        Previous conversation:
-        {history_str}
+    A plain `history[-3:]` shifts by one turn on every question, which changes
+    the prompt right after the instructions and defeats prefix caching.
+    `total` is the length of the full history when `history` is only its tail.
+    """
+    total = len(history) if total is None else total
+    step = max(1, max_turns - 1)
+    start = math.ceil(max(0, total - max_turns) / step) * step
+    return history[max(0, len(history) - (total - start)):]
 
-        Please provide a comprehensive answer. [/INST]"""
+async def generate_response(
+    model: Llama,
+    conv_manager: ConversationManager,
+    query: str,
+    temperature: float = 0.2,
+    use_history = True,
+    query_vector = None,
+    context = None
+) -> str:
+    """Generate response using context from IndexingManager"""
+    loop = asyncio.get_event_loop()
+    with span("llm.prompt"):
+        full_prompt = await build_full_prompt(conv_manager, query, use_history, query_vector, model, context)
     print("Generating answer to your question...")
     # Run model inference in executor
-    response = await loop.run_in_executor(
-        None,
-        lambda: model.create_chat_completion(
-            messages=[{"role": "user", "content": full_prompt}],
-            temperature=temperature,
-            max_tokens=512
+    with span("llm.generate") as attributes:
+        start_time = time.perf_counter()
+        response = await loop.run_in_executor(
+            None,
+            lambda: model.create_chat_completion(
+                messages=[{"role": "user", "content": full_prompt}],
+                temperature=temperature,
+                max_tokens=MAX_NEW_TOKENS
+            )
         )
-    )
+        usage = response.get('usage') or {}
+        attributes.update(prompt_tokens=usage.get('prompt_tokens', 0), completion_tokens=usage.get('completion_tokens', 0))
+        record_generation(attributes['prompt_tokens'], attributes['completion_tokens'], time.perf_counter() - start_time)
     
     return response['choices'][0]['message']['content']
 
-    
\ No newline at end of file
+async def stream_response(
+    model: Llama,
+    conv_manager: ConversationManager,
+    query: str,
+    temperature: float = 0.2,
+    use_history = True,
+    query_vector = None
+):
+    """Yield the answer token by token as llama.cpp produces it.
+
+    Generation runs in an executor thread and hands tokens over through a
+    queue. If the consumer stops early (e.g. the client disconnects), the thread
+    is told to stop, which frees the model for the next request.
+    """
+    loop = asyncio.get_event_loop()
+    start_time = time.perf_counter()  # TTFT includes retrieval, as the user sees it
+    with span("llm.prompt"):
+        full_prompt = await build_full_prompt(conv_manager, query, use_history, query_vector, model)
+    tokens = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+    counts = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    def produce():
+        try:
+            counts["prompt_tokens"] = len(model.tokenize(full_prompt.encode("utf-8"), add_bos=False))
+            for chunk in model.create_chat_completion(
+                messages=[{"role": "user", "content": full_prompt}],
+                temperature=temperature,
+                max_tokens=MAX_NEW_TOKENS,
+                stream=True
+            ):
+                if stop.is_set():
+                    break
+                content = chunk['choices'][0]['delta'].get('content')
+                if content:
+                    counts["completion_tokens"] += 1
+                    loop.call_soon_threadsafe(tokens.put_nowait, content)
+        except Exception as e:
+            loop.call_soon_threadsafe(tokens.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, done)
+
+    print("Streaming answer to your question...")
+    generate_start = time.perf_counter()
+    producer = loop.run_in_executor(None, produce)
+    first_token = True
+    try:
+        while (token := await tokens.get()) is not done:
+            if isinstance(token, Exception):
+                raise token
+            if first_token:
+                ttft = time.perf_counter() - start_time
+                streaming_metrics["ttft_seconds_total"] += ttft
+                streaming_metrics["ttft_seconds_max"] = max(streaming_metrics["ttft_seconds_max"], ttft)
+                streaming_metrics["streams"] += 1
+                TTFT_SECONDS.observe(ttft)
+                first_token = False
+            yield token
+    finally:
+        if not producer.done():
+            streaming_metrics["cancelled"] += 1
+            stop.set()
+        # Keep the model leased until the generation thread has really stopped,
+        # even while the request task is being cancelled
+        with anyio.CancelScope(shield=True):
+            await producer
+        # Not a `with span` block: the generator may be closed from another task
+        generate_seconds = time.perf_counter() - generate_start
+        record_generation(counts["prompt_tokens"], counts["completion_tokens"], generate_seconds)
+        record_span("llm.stream", generate_seconds, cancelled=stop.is_set(), **counts)
+
+def streaming_stats() -> dict:
+    streams = streaming_metrics["streams"]
+    return {
+        **streaming_metrics,
+        "ttft_seconds_avg": streaming_metrics["ttft_seconds_total"] / streams if streams else 0.0,
+    }
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from .conversation_manager import AsyncModelManager
+from .scheduler import InferenceScheduler, PoolExhaustedError
+
+
+class ModelPool:
+    """Process-wide pool of preloaded Llama instances leased to requests.
+
+    Models are loaded once (usually at API startup) and handed out with
+    `lease()` through an InferenceScheduler, which orders waiting requests
+    fairly across users and rejects new ones once its queue is full, so RAM
+    and latency stay bounded. The CPU threads of the machine are split between
+    the models instead of every model using all of them.
+    """
+
+    def __init__(self, size: int = 1, max_waiters: int = 8, max_waiters_per_user: int = 2,
+                 lease_timeout: float = 300.0, n_threads: int = None, prompt_cache_bytes: int = 1024 ** 3,
+                 model_name: str = "mistral/mistral-7b-instruct-v0.1.Q4_K_M.gguf"):
+        self.size = size
+        self.lease_timeout = lease_timeout
+        self.n_threads = n_threads or max(1, len(os.sched_getaffinity(0)) // size)
+        self.prompt_cache_bytes = prompt_cache_bytes  # Split between the models
+        self.model_name = model_name
+        self.managers = []
+        self.scheduler = InferenceScheduler(max_waiters, max_waiters_per_user)
+        self._started = False
+        self._start_lock = asyncio.Lock()
+        self.metrics = {"load_seconds": 0.0}
+
+    @classmethod
+    def from_env(cls):
+        """Build a pool configured through LLM_POOL_* environment variables."""
+        # Every uvicorn worker has its own pool, so the cores are split between all of them
+        size = int(os.getenv("LLM_POOL_SIZE", "1"))
+        workers = int(os.getenv("UVICORN_WORKERS", "1"))
+        n_threads = int(os.getenv("LLM_POOL_THREADS", "0")) or max(1, len(os.sched_getaffinity(0)) // (size * workers))
+        return cls(
+            size=size,
+            max_waiters=int(os.getenv("LLM_POOL_MAX_WAITERS", "8")),
+            max_waiters_per_user=int(os.getenv("LLM_POOL_MAX_WAITERS_PER_USER", "2")),
+            lease_timeout=float(os.getenv("LLM_POOL_LEASE_TIMEOUT", "300")),
+            n_threads=n_threads,
+            prompt_cache_bytes=int(float(os.getenv("LLM_PROMPT_CACHE_MB", "1024")) * 1024 ** 2),
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self._started
+
+    async def start(self, warmup: bool = True):
+        """Load every model of the pool once, optionally running a warmup completion"""
+        async with self._start_lock:
+            if self._started:
+                return
+            start_time = time.perf_counter()
+            # Models are loaded one after the other so concurrent mlock calls
+            # do not compete for RAM.
+            for _ in range(self.size):
+                manager = AsyncModelManager(self.model_name, n_threads=self.n_threads,
+                                           prompt_cache_bytes=self.prompt_cache_bytes // self.size)
+                model = await manager.load_model()
+                if warmup:
+                    await self._warmup(model)
+                self.managers.append(manager)
+                self.scheduler.add(model)
+            self.metrics["load_seconds"] = time.perf_counter() - start_time
+            self._started = True
+            print(f"Model pool ready with {self.size} model(s) x {self.n_threads} threads in {self.metrics['load_seconds']:.1f}s")
+
+    @staticmethod
+    async def _warmup(model):
+        """Evaluate a tiny prompt so the weights are paged in before the first request"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None,
+            lambda: model.create_completion("Hello", max_tokens=1)
+        )
+
+    @asynccontextmanager
+    async def lease(self, user: str = "default", priority: int = 0):
+        """Borrow a model for the duration of the `async with` block, waiting for `user`'s turn"""
+        if not self._started:
+            await self.start()
+        model = await self.scheduler.acquire(user, priority, timeout=self.lease_timeout)
+        try:
+            yield model
+        finally:
+            self.scheduler.add(model)
+
+    def stats(self) -> dict:
+        """Snapshot of the pool state and scheduling metrics"""
+        return {
+            **self.metrics,
+            **self.scheduler.stats(),
+            "size": self.size,
+            "n_threads": self.n_threads,
+            "prompt_cache": [manager.llm.cache.stats() for manager in self.managers
+                             if manager.llm is not None and manager.llm.cache is not None],
+        }
+
+    async def close(self):
+        """Drop the references to the loaded models"""
+        self.scheduler.drain()
+        for manager in self.managers:
+            manager.llm = None
+        self.managers = []
+        self._started = False
@@ -0,0 +1,43 @@
+from llama_cpp.llama_cache import LlamaRAMCache
+
+
+class PromptCache(LlamaRAMCache):
+    """LRU of llama.cpp states keyed by the tokens they evaluated.
+
+    Set on a model with `Llama.set_cache`: before a completion, llama-cpp
+    restores the cached state with the longest common token prefix, so a new
+    turn of a conversation only evaluates the part of the prompt that changed.
+    Unlike LlamaRAMCache, the capacity also counts the logits saved with each
+    state, which are tens of MB for a 32k vocabulary.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        super().__init__(capacity_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _state_bytes(state):
+        return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+    @property
+    def cache_size(self):
+        return sum(self._state_bytes(state) for state in list(self.cache_state.values()))
+
+    def __getitem__(self, key):
+        try:
+            state = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return state
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.cache_state),
+            "bytes": self.cache_size,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
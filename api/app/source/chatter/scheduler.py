@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from ..telemetry import QUEUE_WAIT_SECONDS
+
+
+class PoolExhaustedError(RuntimeError):
+    """Raised when a request cannot be admitted to the inference queue."""
+
+
+class InferenceScheduler:
+    """Single fair queue handing out a fixed set of resources (the pool's models).
+
+    Requests wait in one queue per user. When a model frees up it goes to the
+    waiting request with the highest priority and, among equal priorities, to
+    the user who has been served least (start-time fair queueing), so one user
+    sending many questions cannot starve the others. Admission is bounded both
+    globally and per user, so overload turns into fast rejections instead of an
+    ever-growing queue.
+    """
+
+    def __init__(self, max_queue: int = 8, max_queue_per_user: int = 2):
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self._idle = deque()
+        self._waiting = {}  # user -> deque of (priority, seq, future)
+        self._served = {}   # waiting user -> virtual time of their last grant
+        self._virtual_time = 0
+        self._seq = itertools.count()
+        self.metrics = {
+            "granted": 0,
+            "rejected": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "queue_depth_max": 0,
+        }
+
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def add(self, resource):
+        """Make a resource available to waiting requests"""
+        self._idle.append(resource)
+        self._dispatch()
+
+    def drain(self):
+        """Take every idle resource out of the scheduler"""
+        resources = list(self._idle)
+        self._idle.clear()
+        return resources
+
+    def _next_user(self):
+        def rank(user):
+            priority, seq, _ = self._waiting[user][0]
+            return (-priority, self._served[user], seq)
+        return min(self._waiting, key=rank)
+
+    def _dispatch(self):
+        while self._idle and self._waiting:
+            user = self._next_user()
+            waiters = self._waiting[user]
+            _, _, future = waiters.popleft()
+            if not future.done():
+                self._served[user] += 1
+                self._virtual_time = max(self._virtual_time, self._served[user])
+                future.set_result(self._idle.popleft())
+            if not waiters:
+                del self._waiting[user], self._served[user]
+
+    def _remove(self, user, future):
+        waiters = self._waiting.get(user)
+        if waiters is None:
+            return
+        for entry in waiters:
+            if entry[2] is future:
+                waiters.remove(entry)
+                break
+        if not waiters:
+            del self._waiting[user], self._served[user]
+
+    async def acquire(self, user: str = "default", priority: int = 0, timeout: float = None):
+        """Wait for a resource on behalf of `user`; higher `priority` is served first"""
+        if not self._idle or self._waiting:
+            depth = self.queue_depth()
+            if depth >= self.max_queue or len(self._waiting.get(user, ())) >= self.max_queue_per_user:
+                self.metrics["rejected"] += 1
+                raise PoolExhaustedError("All models are busy, try again later.")
+
+        if user not in self._waiting:
+            # A user becoming active starts at the current virtual time, so idle
+            # users do not bank credit and heavy users are not starved forever
+            self._served[user] = self._virtual_time
+            self._waiting[user] = deque()
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[user].append((priority, next(self._seq), future))
+        self.metrics["queue_depth_max"] = max(self.metrics["queue_depth_max"], self.queue_depth())
+        self._dispatch()
+
+        start_time = time.perf_counter()
+        try:
+            resource = await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # Granted just as we gave up: hand it to the next request
+                self.add(future.result())
+            else:
+                future.cancel()
+                self._remove(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.metrics["timeouts"] += 1
+                raise PoolExhaustedError("Timed out waiting for a free model.")
+            raise
+        waited = time.perf_counter() - start_time
+        QUEUE_WAIT_SECONDS.observe(waited)
+        self.metrics["granted"] += 1
+        self.metrics["wait_seconds_total"] += waited
+        self.metrics["wait_seconds_max"] = max(self.metrics["wait_seconds_max"], waited)
+        return resource
+
+    def stats(self) -> dict:
+        granted = self.metrics["granted"]
+        return {
+            **self.metrics,
+            "idle": self.idle(),
+            "queue_depth": self.queue_depth(),
+            "waiting_per_user": {user: len(waiters) for user, waiters in self._waiting.items()},
+            "wait_seconds_avg": self.metrics["wait_seconds_total"] / granted if granted else 0.0,
+        }
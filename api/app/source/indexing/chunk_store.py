@@ -0,0 +1,128 @@
+import json
+import os
+import numpy as np
+from pathlib import Path
+
+
+ENTRY_DTYPE = np.dtype([
+    ("id", np.int64),
+    ("offset", np.int64),
+    ("length", np.int32),
+    ("url", np.int32),
+    ("start", np.int32),
+    ("end", np.int32),
+])
+
+
+class ChunkStore:
+    """Chunk text and source metadata persisted next to the FAISS index.
+
+    `<name>.chunks.bin` holds the UTF-8 text of every chunk back to back and
+    `<name>.chunks.idx.npy` one fixed-size entry per chunk (ID, byte offset and
+    length, URL number, character offsets), sorted by chunk ID. Both are
+    memory-mapped, so loading is O(1) and only the chunks that are looked up
+    get paged in. URLs are kept once each in `<name>.chunks.urls.json`.
+    """
+
+    def __init__(self, index_dir, name):
+        self.blob_path = Path(index_dir) / f"{name}.chunks.bin"
+        self.entries_path = Path(index_dir) / f"{name}.chunks.idx.npy"
+        self.urls_path = Path(index_dir) / f"{name}.chunks.urls.json"
+        self.entries = None
+        self.blob = None
+        self.urls = None
+
+    def exists(self):
+        return all(path.exists() for path in (self.blob_path, self.entries_path, self.urls_path))
+
+    def write(self, ids, texts, metadata):
+        """Write the store atomically (each file is replaced once fully written)"""
+        urls = sorted({m["url"] for m in metadata})
+        url_numbers = {url: number for number, url in enumerate(urls)}
+        encoded = [str(text).encode("utf-8") for text in texts]
+        lengths = np.fromiter((len(data) for data in encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(encoded) else lengths
+
+        entries = np.empty(len(encoded), dtype=ENTRY_DTYPE)
+        entries["id"] = np.asarray(ids, dtype=np.int64)
+        entries["offset"] = offsets
+        entries["length"] = lengths
+        entries["url"] = [url_numbers[m["url"]] for m in metadata]
+        entries["start"] = [m["start"] for m in metadata]
+        entries["end"] = [m["end"] for m in metadata]
+        entries.sort(order="id")
+
+        tmp_suffix = f".tmp{os.getpid()}"
+        with open(f"{self.blob_path}{tmp_suffix}", "wb") as f:
+            for data in encoded:
+                f.write(data)
+        with open(f"{self.entries_path}{tmp_suffix}", "wb") as f:
+            np.save(f, entries)
+        with open(f"{self.urls_path}{tmp_suffix}", "w") as f:
+            json.dump(urls, f)
+        for path in (self.blob_path, self.entries_path, self.urls_path):
+            os.replace(f"{path}{tmp_suffix}", path)
+        self.open()
+
+    def open(self):
+        """Memory-map the store files"""
+        self.entries = np.load(self.entries_path, mmap_mode="r")
+        if os.path.getsize(self.blob_path):
+            self.blob = np.memmap(self.blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+        with open(self.urls_path) as f:
+            self.urls = json.load(f)
+        return self
+
+    def __len__(self):
+        return 0 if self.entries is None else len(self.entries)
+
+    def _rows(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.entries):
+            return np.zeros(ids.shape, dtype=np.int64), np.zeros(ids.shape, dtype=bool)
+        rows = np.minimum(np.searchsorted(self.entries["id"], ids), len(self.entries) - 1)
+        return rows, self.entries["id"][rows] == ids
+
+    def _entry_text(self, entry):
+        offset, length = int(entry["offset"]), int(entry["length"])
+        return bytes(self.blob[offset:offset + length]).decode("utf-8")
+
+    def _entry_metadata(self, entry):
+        return {
+            "id": int(entry["id"]),
+            "url": self.urls[int(entry["url"])],
+            "start": int(entry["start"]),
+            "end": int(entry["end"]),
+        }
+
+    def lookup(self, ids):
+        """Return (texts, metadata) for `ids` (any shape); unknown IDs give "" and None"""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows, found = self._rows(ids.ravel())
+        texts, metadata = [], []
+        for row, ok in zip(rows, found):
+            if not ok:
+                # Row 0 may not even exist in an empty store
+                texts.append("")
+                metadata.append(None)
+                continue
+            entry = self.entries[row]
+            texts.append(self._entry_text(entry))
+            metadata.append(self._entry_metadata(entry))
+        texts = np.array(texts, dtype=object).reshape(ids.shape)
+        metadata = np.array(metadata, dtype=object).reshape(ids.shape)
+        return texts, metadata
+
+    def pages(self, urls):
+        """All (ids, texts, metadata) of the chunks belonging to `urls`"""
+        wanted = set(urls)
+        url_numbers = [number for number, url in enumerate(self.urls) if url in wanted]
+        entries = self.entries[np.isin(self.entries["url"], url_numbers)]
+        entries = entries[np.argsort(entries["offset"], kind="stable")]  # original order
+        return (
+            [int(entry["id"]) for entry in entries],
+            [self._entry_text(entry) for entry in entries],
+            [self._entry_metadata(entry) for entry in entries],
+        )
@@ -1,10 +1,308 @@
-import os
+import hashlib
+import re
+import threading
 import numpy as np
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from collections import OrderedDict
 
 
-def build_chunks_from_tree(tree, chunk_size = 384):
-    text_to_be_chunked = tree.root.text
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=28)
-    docs = np.array(text_splitter.split_text(text_to_be_chunked))
-    return docs
\ No newline at end of file
+HEADING_LEVELS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6, "head": 2}
+CONTAINER_TAGS = {"html", "body", "div", "section", "article", "main", "doc", "main-content"}
+LIST_TAGS = {"ul", "ol", "list", "dl"}
+ITEM_TAGS = {"li", "item", "dt", "dd"}
+ROW_TAGS = {"tr", "row"}
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _iter_nodes(node):
+    yield node
+    for child in node.children:
+        yield from _iter_nodes(child)
+
+def chunk_id(url, text, occurrence=0):
+    """Stable 63-bit ID of a chunk, derived from its page URL and content.
+
+    `occurrence` tells apart identical chunks repeated on the same page.
+    """
+    digest = hashlib.sha256(f"{url}\0{occurrence}\0{text}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") >> 1
+
+
+class TokenCounter:
+    """Token counts of texts under the embedding model's tokenizer, batched and memoized.
+
+    Pages of a site repeat many blocks (headings, table headers, notices) and
+    re-indexing a site chunks every page again, so counts are cached by text.
+    Without a tokenizer, words and punctuation marks are counted instead.
+    """
+
+    def __init__(self, tokenize_batch=None, max_entries=100_000):
+        self.tokenize_batch = tokenize_batch  # list of texts -> list of token ID lists
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_model(cls, client):
+        """Counter using the tokenizer of a sentence-transformers model, if it has one"""
+        tokenizer = getattr(client, "tokenizer", None)
+        if tokenizer is None:
+            return cls()
+        return cls(lambda texts: tokenizer(texts, add_special_tokens=False, verbose=False)["input_ids"])
+
+    def counts(self, texts):
+        with self._lock:
+            cached = {text: self._cache.get(text) for text in texts}
+        missing = [text for text, count in cached.items() if count is None]
+        if missing:
+            if self.tokenize_batch is None:
+                computed = [len(_WORD_RE.findall(text)) for text in missing]
+            else:
+                # One call for the whole batch; fast tokenizers encode it in parallel
+                computed = [len(ids) for ids in self.tokenize_batch(missing)]
+            cached.update(zip(missing, computed))
+            with self._lock:
+                self._cache.update(zip(missing, computed))
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return [cached[text] for text in texts]
+
+
+class _Unit:
+    """One block of a page (heading, paragraph, list item or table row) with its section context"""
+
+    def __init__(self, kind, text, context):
+        self.kind = kind
+        self.text = text
+        self.context = context  # Enclosing headings, plus the header row for table rows
+        self.tokens = 0
+        self.context_tokens = 0
+        self.start = 0
+        self.end = 0
+
+
+def _clean(text):
+    return " ".join(text.split())
+
+
+def _html_units(html_text):
+    """Units of trafilatura's HTML output, in document order"""
+    from lxml import html as lxml_html  # Imported with the first page, like trafilatura
+    units = []
+    headings = []  # (level, text) of the enclosing headings
+
+    def context(extra=None):
+        parts = [" > ".join(text for _, text in headings)] if headings else []
+        return "\n".join(parts + ([extra] if extra else []))
+
+    def walk(element):
+        for child in element:
+            tag = child.tag.lower() if isinstance(child.tag, str) else ""
+            if not tag:
+                continue
+            if tag in HEADING_LEVELS:
+                text = _clean(child.text_content())
+                if text:
+                    level = HEADING_LEVELS[tag]
+                    while headings and headings[-1][0] >= level:
+                        headings.pop()
+                    units.append(_Unit("heading", text, context()))
+                    headings.append((level, text))
+            elif tag in LIST_TAGS:
+                for item in child:
+                    if isinstance(item.tag, str) and item.tag.lower() in ITEM_TAGS:
+                        text = _clean(item.text_content())
+                        if text:
+                            units.append(_Unit("item", f"- {text}", context()))
+            elif tag == "table":
+                header = None
+                for row in child.iter(*ROW_TAGS):
+                    text = " | ".join(_clean(cell.text_content()) for cell in row)
+                    if not text.strip(" |"):
+                        continue
+                    if header is None:
+                        header = text
+                        units.append(_Unit("row", text, context()))
+                    else:
+                        units.append(_Unit("row", text, context(header)))
+            elif tag in CONTAINER_TAGS:
+                walk(child)
+            else:
+                text = _clean(child.text_content())
+                if text:
+                    units.append(_Unit("text", text, context()))
+
+    walk(lxml_html.fromstring(html_text))
+    return units
+
+
+def _text_units(text):
+    """Units of the plain text of pages stored without HTML: one per line, tables and lists recognized"""
+    units = []
+    header = None
+    for line in text.splitlines():
+        line = _clean(line)
+        if not line or re.fullmatch(r"[|\-: ]+", line):
+            continue
+        if line.startswith("|"):
+            row = " | ".join(cell.strip() for cell in line.strip("|").split("|"))
+            units.append(_Unit("row", row, header or ""))
+            header = header or row
+            continue
+        header = None
+        units.append(_Unit("item" if line.startswith("- ") else "text", line, ""))
+    return units
+
+
+class Chunker:
+    """Structure-aware chunking of crawled pages, sized in tokens of the embedding model.
+
+    Pages are read as blocks from the `html_text` trafilatura produced:
+    headings, paragraphs, list items and table rows. Consecutive blocks are
+    packed into chunks of at most `max_tokens` tokens, so no chunk gets
+    truncated by the embedder. A heading starts a new chunk once the current
+    one is at least `min_fill` full. Each chunk begins with the headings it
+    sits under, and table rows continuing a table repeat its header row. A
+    block longer than a chunk is split at sentence ends.
+
+    A block of at least `dedupe_min_chars` characters that was already seen
+    on another page of the same run (menus, cookie notices, footers that
+    survived extraction) is dropped, so each copy is embedded only once. The
+    first page chunked keeps it, so pages must be passed in a stable order
+    (LinkTree calls `on_page` in queue order) for chunk IDs to stay the same
+    across crawls. Use one Chunker per indexing run.
+    """
+
+    def __init__(self, token_counter=None, max_tokens=256, min_fill=0.5, dedupe_min_chars=40):
+        self.counter = token_counter or TokenCounter()
+        self.max_tokens = max_tokens
+        self.min_fill = min_fill
+        self.dedupe_min_chars = dedupe_min_chars
+        self._seen = set()
+        self._seen_lock = threading.Lock()
+        self.duplicates_dropped = 0
+
+    def _units(self, node):
+        units = _html_units(node.html_text) if node.html_text else _text_units(node.text)
+        kept = []
+        with self._seen_lock:
+            for unit in units:
+                if unit.kind != "heading" and len(unit.text) >= self.dedupe_min_chars:
+                    key = hashlib.sha1(unit.text.lower().encode()).digest()
+                    if key in self._seen:
+                        self.duplicates_dropped += 1
+                        continue
+                    self._seen.add(key)
+                kept.append(unit)
+        return kept
+
+    @staticmethod
+    def _locate(units, text):
+        """Character offsets of the units in the page text; units are searched in order"""
+        cursor = 0
+        for unit in units:
+            needle = unit.text[2:] if unit.kind == "item" else unit.text.split(" | ")[0]
+            position = text.find(needle[:40], cursor) if needle else -1
+            unit.start = position if position >= 0 else cursor
+            unit.end = min(len(text), unit.start + len(unit.text))
+            cursor = unit.start
+
+    def _split(self, text, limit):
+        """Pieces of at most `limit` tokens, cut at sentence ends, or between words in long sentences"""
+        sentences = _SENTENCE_RE.split(text)
+        if len(sentences) == 1:
+            words = text.split()
+            if len(words) < 2:
+                return [text]
+            pieces = [" ".join(words[:len(words) // 2]), " ".join(words[len(words) // 2:])]
+        else:
+            pieces = []
+            for sentence in sentences:
+                if pieces and self.counter.counts([f"{pieces[-1]} {sentence}"])[0] <= limit:
+                    pieces[-1] = f"{pieces[-1]} {sentence}"
+                else:
+                    pieces.append(sentence)
+        result = []
+        for piece, count in zip(pieces, self.counter.counts(pieces)):
+            result.extend(self._split(piece, limit) if count > limit else [piece])
+        return result
+
+    def _fit(self, units):
+        """Count tokens of units and contexts in one batch, splitting units that cannot fit in a chunk"""
+        counts = self.counter.counts([unit.text for unit in units] + [unit.context for unit in units])
+        fitted = []
+        for unit, tokens, context_tokens in zip(units, counts, counts[len(units):]):
+            if context_tokens > self.max_tokens // 4:
+                # Drop a breadcrumb that would take over the chunk
+                unit.context, context_tokens = "", 0
+            unit.tokens, unit.context_tokens = tokens, context_tokens
+            limit = self.max_tokens - context_tokens
+            if tokens <= limit or unit.kind == "heading":
+                fitted.append(unit)
+                continue
+            pieces = self._split(unit.text, limit)
+            for piece, piece_tokens in zip(pieces, self.counter.counts(pieces)):
+                part = _Unit(unit.kind, piece, unit.context)
+                part.tokens, part.context_tokens = piece_tokens, context_tokens
+                part.start, part.end = unit.start, unit.end
+                fitted.append(part)
+        return fitted
+
+    def _pack(self, units):
+        chunks = []
+        current, used = [], 0
+        for unit in units:
+            new_section = unit.kind == "heading" and used >= self.min_fill * self.max_tokens
+            if current and (new_section or used + unit.tokens > self.max_tokens):
+                # Headings go with the content that follows them
+                carried = []
+                while current and current[-1].kind == "heading":
+                    carried.insert(0, current.pop())
+                carried_tokens = sum(heading.tokens for heading in carried)
+                if carried and carried[0].context_tokens + carried_tokens + unit.tokens > self.max_tokens:
+                    current, carried, carried_tokens = current + carried, [], 0
+                if current:
+                    chunks.append(current)
+                current = carried
+                used = carried[0].context_tokens + carried_tokens if carried else 0
+            if not current:
+                used = unit.context_tokens
+            current.append(unit)
+            used += unit.tokens
+        if current:
+            chunks.append(current)
+        # A chunk of headings only has nothing to retrieve
+        return [chunk for chunk in chunks if any(unit.kind != "heading" for unit in chunk)]
+
+    def chunk_page(self, node):
+        """Chunks of one crawled page and their metadata (ID, source URL, character offsets in `node.text`)"""
+        if not node.text:
+            return [], []
+        units = self._units(node)
+        self._locate(units, node.text)
+        chunks, metadata = [], []
+        seen = {}
+        for chunk_units in self._pack(self._fit(units)):
+            context = chunk_units[0].context
+            chunk = "\n".join(([context] if context else []) + [unit.text for unit in chunk_units])
+            occurrence = seen[chunk] = seen.get(chunk, -1) + 1
+            chunks.append(chunk)
+            metadata.append({
+                "id": chunk_id(node.url, chunk, occurrence),
+                "url": node.url,
+                "start": chunk_units[0].start,
+                "end": max(unit.end for unit in chunk_units),
+            })
+        return chunks, metadata
+
+
+def build_chunks_from_tree(tree, chunker=None):
+    """Chunk every page of the crawled tree, not only the root."""
+    chunker = chunker or Chunker()
+    chunks, metadata = [], []
+    for node in _iter_nodes(tree.root):
+        page_chunks, page_metadata = chunker.chunk_page(node)
+        chunks.extend(page_chunks)
+        metadata.extend(page_metadata)
+    return np.array(chunks), metadata
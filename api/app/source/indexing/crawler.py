@@ -0,0 +1,104 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+import httpx
+
+
+DEFAULT_HEADERS = {"User-Agent": "llm-chunking/0.1 (+https://github.com/Rfelip/llm-chunking)"}
+
+
+class HostRateLimiter:
+    """Per-host politeness: caps concurrent requests and spaces them in time."""
+
+    def __init__(self, per_host_concurrency=2, min_delay=0.25):
+        self.per_host_concurrency = per_host_concurrency
+        self.min_delay = min_delay
+        self._semaphores = {}
+        self._locks = {}
+        self._last_request = {}
+
+    def _host_state(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host_concurrency)
+            self._locks[host] = asyncio.Lock()
+            self._last_request[host] = 0.0
+        return self._semaphores[host], self._locks[host]
+
+    async def _wait_turn(self, host, lock):
+        async with lock:
+            elapsed = time.monotonic() - self._last_request[host]
+            if elapsed < self.min_delay:
+                await asyncio.sleep(self.min_delay - elapsed)
+            self._last_request[host] = time.monotonic()
+
+    async def run(self, url, coro_factory):
+        """Run `coro_factory()` once the host of `url` allows another request"""
+        host = urlparse(url).netloc
+        semaphore, lock = self._host_state(host)
+        async with semaphore:
+            await self._wait_turn(host, lock)
+            return await coro_factory()
+
+
+class FetchResult:
+    """Response of `CrawlSession.fetch_page`: HTML text (None if unusable) and cache validators."""
+
+    def __init__(self, status, text, etag=None, last_modified=None):
+        self.status = status
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+    @property
+    def gone(self):
+        """The page no longer exists; other errors (429, 5xx...) may be transient"""
+        return self.status in (404, 410)
+
+
+class CrawlSession:
+    """Pooled keep-alive HTTP client plus rate limiting shared by a whole crawl."""
+
+    def __init__(self, workers=8, per_host_concurrency=2, min_host_delay=0.25, request_timeout=30.0):
+        self.workers = workers
+        self.limiter = HostRateLimiter(per_host_concurrency, min_host_delay)
+        self.client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=request_timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+        )
+
+    async def fetch_page(self, url, etag=None, last_modified=None):
+        """Download `url`, revalidating a cached copy when its validators are given"""
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        async def _get():
+            return await self.client.get(url, headers=headers)
+
+        response = await self.limiter.run(url, _get)
+        result = FetchResult(response.status_code, None, response.headers.get("etag"),
+                             response.headers.get("last-modified"))
+        if response.status_code != 200:
+            return result
+        content_type = response.headers.get("content-type", "")
+        if content_type and "html" not in content_type:
+            return result
+        result.text = response.text
+        return result
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -1,48 +1,175 @@
 import os
+import json
 import numpy as np
-from langchain_huggingface import HuggingFaceEmbeddings
 import faiss
+from .embedding_cache import EmbeddingCache
+from .chunk_store import ChunkStore
+from .lexical_index import BM25Index
+from ..telemetry import EMBEDDED_TEXTS, EMBEDDING_CACHE_LOOKUPS, span, traced
+from .index_factory import (choose_index_type, default_params, build_index, apply_search_params,
+                            empty_flat_index, wrap_with_ids, remove_ids, stored_ids, undelete_ids,
+                            search_parameters)
+from datetime import datetime, timezone
+
+# Embedding models shared by every EmbeddingManager of the process, keyed by model name
+_loaded_models = {}
+# Memoized token counters of those models, shared the same way
+_token_counters = {}
+
+
+def default_num_threads():
+    """EMBEDDING_THREADS, else this uvicorn worker's share of the CPUs, like the LLM pool's budget"""
+    configured = int(os.getenv("EMBEDDING_THREADS", "0"))
+    if configured:
+        return configured
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    return max(1, len(os.sched_getaffinity(0)) // workers)
+
+
+def get_model(model_name="all-mpnet-base-v2", model_dir='data/models'):
+    """The shared embedding model, loaded from `model_dir` or downloaded there on first use"""
+    if model_name not in _loaded_models:
+        # torch and transformers are only imported with the first embedding model
+        from langchain_huggingface import HuggingFaceEmbeddings
+        os.makedirs(model_dir, exist_ok=True)
+        print("Loading model from local directory or downloading it...")
+        _loaded_models[model_name] = HuggingFaceEmbeddings(
+            cache_folder = os.path.join(model_dir, model_name), model_name = model_name,
+            encode_kwargs={'normalize_embeddings': True, 'convert_to_numpy' : True},
+            model_kwargs = {'device': 'cpu'})
+    return _loaded_models[model_name]
+
 
 class EmbeddingManager:
-    def __init__(self, model_name="all-mpnet-base-v2", model_dir='data/models', index_dir='data/faiss_index'):
+    def __init__(self, model_name="all-mpnet-base-v2", model_dir='data/models', index_dir='data/faiss_index',
+                 batch_size=32, num_threads=None, parallel_mode="threads",
+                 cache_dir='data/embedding_cache', cache_max_bytes=512 * 1024 ** 2,
+                 index_type="auto", metric="ip", retrieval="hybrid"):
         self.model_name = model_name
         self.model_dir = model_dir
         self.index_dir = index_dir
+        self.batch_size = batch_size
+        self.num_threads = num_threads or default_num_threads()
+        self.parallel_mode = parallel_mode  # "threads" (intra-op) or "processes"
+        self.cache_dir = cache_dir  # None disables the embedding cache
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = None
         self.model = None
+        self._process_pool = None
+        self.index_type = index_type  # "auto" or one of index_factory.INDEX_TYPES
+        self.metric = metric  # "ip" works as cosine since embeddings are normalized
+        self.retrieval = retrieval  # "hybrid" (dense + BM25), "dense" or "lexical"
+        self.lexical = None
         self.index = None
+        self.index_params = None
+        self._search_params = (None, None)  # (deleted IDs it was built from, SearchParameters)
         self.chunks = None
+        self.chunk_metadata = None
+        self.chunk_ids = None
+        self.chunk_store = None
+        self._previous_store = None
+        self._previous_pages = {}
+        self._indexed_ids = set()
         os.makedirs(self.model_dir, exist_ok=True)
         os.makedirs(self.index_dir, exist_ok=True)
 
+    @traced("embed.load_model")
     def load_or_download_model(self):
         """Load model from local directory or download if not exists"""
-        model_kwargs = {'device': 'cpu'}
-        encode_kwargs = {'normalize_embeddings': True, 'convert_to_numpy' : True}
-        model_path = os.path.join(self.model_dir, self.model_name)
-        
-        print("Loading model from local directory or downloading it...")
-        self.model = HuggingFaceEmbeddings(cache_folder = model_path, model_name = self.model_name,
-                                            encode_kwargs=encode_kwargs, model_kwargs = model_kwargs)
+        self.model = get_model(self.model_name, self.model_dir)
+        import torch
+        if self.parallel_mode == "processes":
+            self._process_pool = self.model._client.start_multi_process_pool(['cpu'] * self.num_threads)
+        else:
+            torch.set_num_threads(self.num_threads)
         return self.model
 
+    def token_counter(self):
+        """TokenCounter of the model's tokenizer, shared by every chunker using this model"""
+        if not self.model:
+            self.load_or_download_model()
+        if self.model_name not in _token_counters:
+            from .chunker import TokenCounter
+            _token_counters[self.model_name] = TokenCounter.for_model(self.model._client)
+        return _token_counters[self.model_name]
+
+    def max_input_tokens(self, default=256):
+        """Tokens the model reads per text before truncating, special tokens excluded"""
+        if not self.model:
+            self.load_or_download_model()
+        max_seq_length = getattr(self.model._client, "max_seq_length", None)
+        return max_seq_length - 2 if max_seq_length else default
+
     def generate_embeddings(self, chunks):
-        """Convert text chunks to embeddings"""
+        """Convert text chunks to a (len(chunks), dim) float32 matrix of normalized embeddings.
+
+        Chunks are sorted by length and encoded in batches of `batch_size`, so
+        each batch pads to similar lengths; results are written back in input order.
+        """
         if not self.model:
             self.load_or_download_model()
-            
+
         print("Generating embeddings...")
-        embbed = self.model.embed_documents(chunks)
-        return embbed
-
-    def create_faiss_index(self, embeddings):
-        """Create and save FAISS index"""
-        # Convert embeddings to float32 numpy array
-        embeddings = np.array(embeddings).astype('float32')
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(embeddings)
-        print(f"Created FAISS index with {self.index.ntotal} vectors")
+        client = self.model._client
+        texts = [str(chunk).replace("\n", " ") for chunk in chunks]
+        embeddings = np.empty((len(texts), client.get_sentence_embedding_dimension()), dtype=np.float32)
+        if not texts:
+            return embeddings
+        EMBEDDED_TEXTS.inc(len(texts))
+
+        with span("embed.encode", texts=len(texts)):
+            if self._process_pool is not None:
+                embeddings[:] = client.encode_multi_process(
+                    texts, self._process_pool, batch_size=self.batch_size, normalize_embeddings=True
+                )
+                return embeddings
+
+            order = np.argsort([len(text) for text in texts], kind="stable")
+            for start in range(0, len(texts), self.batch_size):
+                batch_ids = order[start:start + self.batch_size]
+                embeddings[batch_ids] = client.encode(
+                    [texts[i] for i in batch_ids], batch_size=len(batch_ids),
+                    normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+                )
+        return embeddings
+
+    def generate_embeddings_cached(self, chunks):
+        """Same as `generate_embeddings`, but only chunks missing from the on-disk cache are encoded"""
+        if self.cache_dir is None:
+            return self.generate_embeddings(chunks)
+        if not self.model:
+            self.load_or_download_model()
+        if self.cache is None:
+            dimension = self.model._client.get_sentence_embedding_dimension()
+            self.cache = EmbeddingCache(self.cache_dir, self.model_name, dimension, self.cache_max_bytes)
+
+        texts = [str(chunk) for chunk in chunks]
+        embeddings, found = self.cache.get_many(texts)
+        missing = np.flatnonzero(~found)
+        EMBEDDING_CACHE_LOOKUPS.inc(len(texts) - len(missing), result="hit")
+        EMBEDDING_CACHE_LOOKUPS.inc(len(missing), result="miss")
+        if len(missing):
+            missing_texts = [texts[i] for i in missing]
+            embeddings[missing] = self.generate_embeddings(missing_texts)
+            self.cache.put_many(missing_texts, embeddings[missing])
+        print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        return embeddings
+
+    def close(self):
+        """Stop the embedding worker processes, if any"""
+        if self._process_pool is not None:
+            self.model._client.stop_multi_process_pool(self._process_pool)
+            self._process_pool = None
+
+    def create_faiss_index(self, embeddings, ids=None):
+        """Create FAISS index, storing vectors under `ids` (stable chunk IDs) when given"""
+        # Embeddings already come as float32; this only copies other inputs
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        ntotal, dimension = embeddings.shape
+        index_type = choose_index_type(ntotal) if self.index_type == "auto" else self.index_type
+        self.index_params = default_params(index_type, ntotal, dimension, self.metric)
+        self.index = build_index(embeddings, self.index_params, ids)
+        print(f"Created {index_type} FAISS index with {self.index.ntotal} vectors")
         return self.index
 
     def save_faiss_index(self, index_name='my_index'):
@@ -50,8 +177,15 @@ class EmbeddingManager:
         if self.index is None:
             raise ValueError("Index not initialized. Create index first.")
             
+        # Written to temporary files and renamed, so workers loading meanwhile never read a partial index
         index_path = os.path.join(self.index_dir, f"{index_name}.index")
-        faiss.write_index(self.index, index_path)
+        faiss.write_index(self.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        # Index type, training and query-time parameters travel with the index
+        params_path = os.path.join(self.index_dir, f"{index_name}.params.json")
+        with open(params_path + ".tmp", "w") as f:
+            json.dump(self.index_params, f, indent=2)
+        os.replace(params_path + ".tmp", params_path)
         print(f"Index saved to {index_path}")
 
     def load_faiss_index(self, index_name='my_index'):
@@ -61,27 +195,228 @@ class EmbeddingManager:
             raise FileNotFoundError(f"No index found at {index_path}")
             
         self.index = faiss.read_index(index_path)
+        params_path = os.path.join(self.index_dir, f"{index_name}.params.json")
+        if os.path.exists(params_path):
+            with open(params_path) as f:
+                self.index_params = json.load(f)
+        else:
+            # Indexes written before parameters were persisted are flat L2
+            self.index_params = {"index_type": "flat", "metric": "l2", "dimension": self.index.d}
+        apply_search_params(self.index, self.index_params)
         print(f"Loaded index with {self.index.ntotal} vectors")
         return self.index
 
-    def generate_index_from_chunks(self, chunks=None, index_name = "index"):
-        """Check for existing index, load if exists; else create from chunks and save."""
-        index_path = os.path.join(self.index_dir, f"{index_name}.index")
-        if os.path.exists(index_path):
+    def index_exists(self, index_name="index"):
+        return os.path.exists(os.path.join(self.index_dir, f"{index_name}.index"))
+
+    def _manifest_path(self, index_name):
+        return os.path.join(self.index_dir, f"{index_name}.manifest.json")
+
+    def load_manifest(self, index_name="index", settings=None):
+        """Return the manifest of `index_name` if it matches this model and `settings`, else None"""
+        manifest_path = self._manifest_path(index_name)
+        if not (os.path.exists(manifest_path) and self.index_exists(index_name)):
+            return None
+        if not ChunkStore(self.index_dir, index_name).exists():
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("model_name") != self.model_name or manifest.get("metric") != self.metric:
+            return None
+        if manifest.get("settings") != (settings or {}):
+            return None
+        return manifest
+
+    def save_manifest(self, index_name="index", settings=None):
+        """Write the manifest tying the index file, its chunk IDs per page and the model together"""
+        pages = {}
+        for chunk_id, metadata in zip(self.chunk_ids, self.chunk_metadata):
+            pages.setdefault(metadata["url"], []).append(int(chunk_id))
+        manifest = {
+            "model_name": self.model_name,
+            "metric": self.metric,
+            "settings": settings or {},
+            "index_file": f"{index_name}.index",
+            "chunk_store": os.path.basename(self.chunk_store.blob_path),
+            "index_type": self.index_params["index_type"],
+            "ntotal": int(self.index.ntotal),
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "pages": pages,
+        }
+        tmp_path = self._manifest_path(index_name) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path(index_name))
+
+    def start_streaming_index(self, index_name="index", settings=None, rebuild=False):
+        """Prepare to receive chunks batch by batch with `add_to_index`.
+
+        If a manifest for the same model and settings exists, the saved index is
+        updated in place: only chunks with new IDs are embedded, and IDs that
+        are no longer produced are removed in `finish_streaming_index`.
+        """
+        manifest = None if rebuild else self.load_manifest(index_name, settings)
+        self.index = None
+        self._indexed_ids = set()
+        self._previous_store = None
+        self._previous_pages = {}
+        if manifest is not None:
             self.load_faiss_index(index_name)
-            self.chunks = chunks
-        else:
-            if chunks is None:
-                raise ValueError("Chunks must be provided to create a new index.")
-            self.chunks = chunks
-            embeddings = self.generate_embeddings(chunks)
-            self.create_faiss_index(embeddings)
-            self.save_faiss_index(index_name)
+            self._indexed_ids = set(stored_ids(self.index, self.index_params).tolist())
+            self._previous_store = ChunkStore(self.index_dir, index_name).open()
+            self._previous_pages = manifest["pages"]
+            print(f"Updating existing index ({len(self._indexed_ids)} vectors) incrementally")
+        self.chunks = []
+        self.chunk_metadata = []
+        self.chunk_ids = []
+
+    def add_to_index(self, chunks, metadata):
+        """Register one batch of chunks, embedding and adding the ones not indexed yet"""
+        ids = [m["id"] for m in metadata]
+        new = [i for i, chunk_id in enumerate(ids) if chunk_id not in self._indexed_ids]
+        if new and self.index_params is not None:
+            # Chunks deleted earlier from an HNSW graph still have their vector there
+            revived = undelete_ids(self.index_params, [ids[i] for i in new])
+            self._indexed_ids.update(ids[i] for i, was_deleted in zip(new, revived) if was_deleted)
+            new = [i for i, was_deleted in zip(new, revived) if not was_deleted]
+        if new:
+            embeddings = self.generate_embeddings_cached([chunks[i] for i in new])
+            if self.index is None:
+                self.index = wrap_with_ids(empty_flat_index(embeddings.shape[1], self.metric))
+                self.index_params = default_params("flat", 0, embeddings.shape[1], self.metric)
+            new_ids = np.array([ids[i] for i in new], dtype=np.int64)
+            self.index.add_with_ids(embeddings, new_ids)
+            self._indexed_ids.update(new_ids.tolist())
+        self.chunks.extend(chunks)
+        self.chunk_metadata.extend(metadata)
+        self.chunk_ids.extend(ids)
+
+    def finish_streaming_index(self, index_name="index", settings=None, complete=True, gone_urls=()):
+        """Drop stale vectors, freeze the streamed chunks and save index, chunk store and manifest.
+
+        When the crawl did not complete (its time budget ran out or some pages
+        failed to fetch), pages of the previous index that were not reached
+        are kept as they were, except the `gone_urls` that answered 404/410.
+        Nothing is saved if the crawl produced no chunks at all.
+        """
+        if self.index is None or not len(self.chunk_ids):
+            self._previous_store = None
+            raise ValueError("No chunks were indexed, the saved index is left as it was.")
+        if not complete and self._previous_store is not None:
+            seen_urls = {m["url"] for m in self.chunk_metadata}
+            gone_urls = set(gone_urls)
+            unvisited = [url for url in self._previous_pages if url not in seen_urls and url not in gone_urls]
+            ids, texts, metadata = self._previous_store.pages(unvisited)
+            self.chunks.extend(texts)
+            self.chunk_metadata.extend(metadata)
+            self.chunk_ids.extend(ids)
+        stale = self._indexed_ids.difference(self.chunk_ids)
+        if stale:
+            print(f"Removing {len(stale)} stale vectors")
+            self.index = remove_ids(self.index, stale, self.index_params)
+            self._indexed_ids -= stale
+        self._set_chunks(self.chunks, self.chunk_metadata, self.chunk_ids)
+
+        if self.index_params["index_type"] == "flat" and self.index_type != "flat":
+            index_type = choose_index_type(self.index.ntotal) if self.index_type == "auto" else self.index_type
+            if index_type != "flat":
+                # ANN indexes need every vector for training, so they are built once streaming is over
+                ids = stored_ids(self.index)
+                vectors = self.index.reconstruct_batch(ids)
+                self.create_faiss_index(vectors, ids)
+        print(f"FAISS index holds {self.index.ntotal} vectors")
+        self.save_faiss_index(index_name)
+        self.chunk_store = ChunkStore(self.index_dir, index_name)
+        self.chunk_store.write(self.chunk_ids, self.chunks, self.chunk_metadata)
+        self.lexical = BM25Index(self.index_dir, index_name).build(self.chunk_ids, self.chunks)
+        self.save_manifest(index_name, settings)
+        self._previous_store = None
         return self.index
-    
+
+    def load_from_disk(self, index_name="index", settings=None):
+        """Load a saved index and its chunk store without crawling; False if there is none"""
+        if self.load_manifest(index_name, settings) is None:
+            return False
+        self.load_faiss_index(index_name)
+        self.chunk_store = ChunkStore(self.index_dir, index_name).open()
+        lexical = BM25Index(self.index_dir, index_name)
+        self.lexical = lexical.open() if lexical.exists() else None  # Indexes built before BM25: dense only
+        print(f"Loaded chunk store with {len(self.chunk_store)} chunks")
+        return True
+
+    def _set_chunks(self, chunks, metadata, ids):
+        self.chunks = np.array(chunks)
+        self.chunk_metadata = metadata
+        self.chunk_ids = np.asarray(ids, dtype=np.int64)
+
+    def chunk_vectors(self, ids, texts):
+        """Embeddings of indexed chunks, read back from the index when it stores them exactly"""
+        if not len(ids):
+            return self.generate_embeddings([])
+        try:
+            return np.vstack([self.index.reconstruct(int(chunk_id)) for chunk_id in ids]).astype(np.float32)
+        except RuntimeError:
+            # IVF indexes keep no direct map for reconstruction: use the embedding cache
+            return self.generate_embeddings_cached(texts)
+
     def search_index(self, query, k = 3):
-        query = np.array(query)
-        query_vector = np.array(self.generate_embeddings(query))
-        SIMILARITY, IDs = self.index.search(query_vector, k)
-        resulting_chunks = self.chunks[IDs]
-        return SIMILARITY, resulting_chunks
\ No newline at end of file
+        SIMILARITY, resulting_chunks, _ = self.search_index_with_sources(query, k)
+        return SIMILARITY, resulting_chunks
+
+    @traced("search")
+    def search_index_with_sources(self, query, k = 3, query_vector=None):
+        """Like `search_index`, also returning the source metadata of each chunk.
+
+        `query_vector` skips embedding the query again when the caller already has it.
+        In hybrid mode, dense and BM25 candidates are fused with reciprocal rank
+        fusion and the returned scores are the fused scores.
+        """
+        if self.retrieval == "lexical" and self.lexical is not None:
+            SIMILARITY, IDs = self._fuse([self._search_lexical(query, k)], k)
+        else:
+            if query_vector is None:
+                query_vector = self.generate_embeddings(query)
+            query_vector = np.atleast_2d(np.asarray(query_vector, dtype=np.float32))
+            params = self._search_parameters()
+            if self.retrieval == "hybrid" and self.lexical is not None:
+                dense = self.index.search(query_vector, 2 * k, params=params)
+                SIMILARITY, IDs = self._fuse([dense, self._search_lexical(query, 2 * k)], k)
+            else:
+                SIMILARITY, IDs = self.index.search(query_vector, k, params=params)
+        resulting_chunks, sources = self.chunk_store.lookup(IDs)
+        return SIMILARITY, resulting_chunks, sources
+
+    def _search_parameters(self):
+        """Search parameters filtering out deleted HNSW vectors, rebuilt only when the deleted IDs change"""
+        deleted = self.index_params.get("deleted") if self.index_params else None
+        if self._search_params[0] is not deleted:
+            self._search_params = (deleted, search_parameters(self.index_params or {}))
+        return self._search_params[1]
+
+    def _search_lexical(self, queries, k):
+        """BM25 results for each query, padded like FAISS results (ID -1)"""
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, query in enumerate(queries):
+            row_scores, row_ids = self.lexical.search(query, k)
+            scores[row, :len(row_ids)] = row_scores
+            ids[row, :len(row_ids)] = row_ids
+        return scores, ids
+
+    @staticmethod
+    def _fuse(rankings, k, rrf_k=60):
+        """Reciprocal rank fusion of several (scores, ids) rankings, per query row"""
+        nq = rankings[0][1].shape[0]
+        fused_scores = np.zeros((nq, k), dtype=np.float32)
+        fused_ids = np.full((nq, k), -1, dtype=np.int64)
+        for row in range(nq):
+            totals = {}
+            for _, ids in rankings:
+                for rank, chunk_id in enumerate(ids[row]):
+                    if chunk_id >= 0:
+                        totals[int(chunk_id)] = totals.get(int(chunk_id), 0.0) + 1.0 / (rrf_k + rank + 1)
+            best = sorted(totals.items(), key=lambda item: -item[1])[:k]
+            for column, (chunk_id, score) in enumerate(best):
+                fused_ids[row, column] = chunk_id
+                fused_scores[row, column] = score
+        return fused_scores, fused_ids
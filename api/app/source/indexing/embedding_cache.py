@@ -0,0 +1,157 @@
+import fcntl
+import hashlib
+import os
+import numpy as np
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by sha256(model_name, chunk text).
+
+    Vectors live in a memory-mapped float32 file that grows with the number of
+    entries, up to `max_bytes`. The 32-byte key of each slot and its last access
+    tick are kept in two small .npy files. Once the cache is full, the least
+    recently used slots are reused.
+    """
+
+    def __init__(self, cache_dir, model_name, dimension, max_bytes=512 * 1024 ** 2):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.capacity = max(1, max_bytes // (dimension * 4))
+        slug = hashlib.sha256(model_name.encode()).hexdigest()[:16]
+        self.cache_dir = Path(cache_dir) / f"{slug}_{dimension}"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.cache_dir / "vectors.f32"
+        self.keys_path = self.cache_dir / "keys.npy"
+        self.ticks_path = self.cache_dir / "ticks.npy"
+        self.lock_path = self.cache_dir / "cache.lock"
+        self.hits = 0
+        self.misses = 0
+        self._loaded_version = None
+        self._touched = {}  # key -> tick of hits not flushed yet, reapplied when reloading
+        self._load_index()
+
+    def _open_vectors(self, allocated):
+        """Map the vector file, growing it to `allocated` slots if needed"""
+        mode = "r+" if self.vectors_path.exists() else "w+"
+        if mode == "r+" and self.vectors_path.stat().st_size < allocated * self.dimension * 4:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(allocated * self.dimension * 4)
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode=mode,
+                                 shape=(allocated, self.dimension))
+
+    def _load_index(self):
+        if self.keys_path.exists() and self.ticks_path.exists():
+            self.keys = np.load(self.keys_path)
+            self.ticks = np.load(self.ticks_path)
+            self._loaded_version = self._version()
+        else:
+            self.keys = np.zeros((0, 32), dtype=np.uint8)
+            self.ticks = np.zeros(0, dtype=np.int64)
+        self.slots = {key.tobytes(): slot for slot, key in enumerate(self.keys)}
+        for key, tick in self._touched.items():
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.ticks[slot] = max(self.ticks[slot], tick)
+        self.tick = int(self.ticks.max()) if len(self.ticks) else 0
+        self._open_vectors(max(len(self.keys), 1))
+
+    def _version(self):
+        # Every flush replaces the file, so the inode changes even within one mtime tick
+        stat = os.stat(self.keys_path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _reload_if_changed(self):
+        """Pick up entries written by other worker processes"""
+        if self.keys_path.exists() and self._version() != self._loaded_version:
+            self._load_index()
+
+    @contextmanager
+    def _locked(self, shared=False):
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).digest()
+
+    def get_many(self, texts):
+        """Return (vectors, found) where `found` marks the texts served from the cache
+
+        Another cache on the same directory (another worker, another
+        EmbeddingManager) may have reused slots since this one loaded, so the
+        index is reloaded under the lock and each slot's key checked on read.
+        """
+        vectors = np.empty((len(texts), self.dimension), dtype=np.float32)
+        found = np.zeros(len(texts), dtype=bool)
+        with self._locked(shared=True):
+            self._reload_if_changed()
+            for i, text in enumerate(texts):
+                key = self.key(text)
+                slot = self.slots.get(key)
+                if slot is not None and self.keys[slot].tobytes() == key:
+                    vectors[i] = self.vectors[slot]
+                    found[i] = True
+                    self.tick += 1
+                    self.ticks[slot] = self._touched[key] = self.tick
+        hits = int(found.sum())
+        self.hits += hits
+        self.misses += len(texts) - hits
+        return vectors, found
+
+    def _take_slots(self, count):
+        """Return `count` slots for new entries: appended while below capacity, then LRU"""
+        appended = min(count, self.capacity - len(self.keys))
+        new_slots = np.arange(len(self.keys), len(self.keys) + appended)
+        evicted = np.argsort(self.ticks, kind="stable")[:count - appended]
+        for slot in evicted:
+            self.slots.pop(self.keys[slot].tobytes(), None)
+        if appended:
+            self.keys = np.concatenate([self.keys, np.zeros((appended, 32), dtype=np.uint8)])
+            self.ticks = np.concatenate([self.ticks, np.zeros(appended, dtype=np.int64)])
+            if len(self.keys) > len(self.vectors):
+                # Grow the file geometrically so appends stay amortized O(1)
+                self.vectors.flush()
+                self._open_vectors(min(self.capacity, max(len(self.keys), 2 * len(self.vectors))))
+        return np.concatenate([new_slots, evicted])
+
+    def put_many(self, texts, vectors):
+        """Store new embeddings, evicting least recently used entries when full"""
+        with self._locked():
+            self._reload_if_changed()
+            entries = {}
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                if key not in self.slots:
+                    entries[key] = vector
+            entries = list(entries.items())[:self.capacity]
+            for (key, vector), slot in zip(entries, self._take_slots(len(entries))):
+                self.tick += 1
+                self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self.ticks[slot] = self.tick
+                self.vectors[slot] = vector
+                self.slots[key] = slot
+            self.flush()
+
+    def flush(self):
+        self.vectors.flush()
+        for path, array in ((self.keys_path, self.keys), (self.ticks_path, self.ticks)):
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+        self._loaded_version = self._version()
+        self._touched.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.slots),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,172 @@
+import math
+import faiss
+import numpy as np
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+def choose_index_type(ntotal):
+    """Pick an index type from the corpus size: exact search while it is cheap, then ANN"""
+    if ntotal < 20_000:
+        return "flat"
+    if ntotal < 200_000:
+        return "hnsw"
+    if ntotal < 2_000_000:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _pq_subquantizers(dimension):
+    """Largest divisor of the dimension giving at least 4 dims per sub-quantizer (at most 64)"""
+    for m in range(min(64, dimension // 4), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def default_params(index_type, ntotal, dimension, metric="ip"):
+    params = {"index_type": index_type, "metric": metric, "dimension": dimension}
+    if index_type == "hnsw":
+        params.update({"M": 32, "efConstruction": 80, "efSearch": 64})
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        # ~4*sqrt(n) lists, keeping at least 39 training points per centroid
+        nlist = max(1, min(int(4 * math.sqrt(ntotal)), ntotal // 39))
+        params.update({"nlist": nlist, "nprobe": max(1, nlist // 16)})
+        if index_type == "ivf_pq":
+            params.update({"m": _pq_subquantizers(dimension), "nbits": 8})
+    return params
+
+
+def _metric(params):
+    return faiss.METRIC_INNER_PRODUCT if params["metric"] == "ip" else faiss.METRIC_L2
+
+
+def empty_flat_index(dimension, metric="ip"):
+    if metric == "ip":
+        return faiss.IndexFlatIP(dimension)
+    return faiss.IndexFlatL2(dimension)
+
+
+def wrap_with_ids(index):
+    """Let the index store caller-provided 64-bit IDs instead of insertion positions"""
+    return faiss.IndexIDMap2(index)
+
+
+def base_index(index):
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def build_index(embeddings, params, ids=None):
+    """Build (and train if needed) the index described by `params` over `embeddings`.
+
+    When `ids` is given the index is wrapped in an IndexIDMap2 and vectors are
+    stored under those IDs.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    dimension = embeddings.shape[1]
+    index_type = params["index_type"]
+    metric = _metric(params)
+
+    if index_type == "flat":
+        index = empty_flat_index(dimension, params["metric"])
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params["M"], metric)
+        index.hnsw.efConstruction = params["efConstruction"]
+    elif index_type == "ivf_flat":
+        quantizer = empty_flat_index(dimension, params["metric"])
+        index = faiss.IndexIVFFlat(quantizer, dimension, params["nlist"], metric)
+    elif index_type == "ivf_pq":
+        quantizer = empty_flat_index(dimension, params["metric"])
+        index = faiss.IndexIVFPQ(quantizer, dimension, params["nlist"], params["m"], params["nbits"], metric)
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+    if not index.is_trained:
+        index.train(embeddings)
+    if ids is None:
+        index.add(embeddings)
+    else:
+        index = wrap_with_ids(index)
+        index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    apply_search_params(index, params)
+    return index
+
+
+# IDs removed from an HNSW graph are only filtered out at search time until they exceed this share of it
+TOMBSTONE_REBUILD_RATIO = 0.2
+
+
+def stored_ids(index, params=None):
+    """IDs of the live vectors of an ID-mapped index, leaving out those deleted from an HNSW graph"""
+    ids = faiss.vector_to_array(index.id_map)
+    deleted = (params or {}).get("deleted")
+    return ids[~np.isin(ids, deleted)] if deleted else ids
+
+
+def remove_ids(index, ids, params):
+    """Remove `ids` from an ID-mapped index, returning the (possibly rebuilt) index.
+
+    HNSW graphs do not support removal: their removed IDs are recorded in
+    `params["deleted"]` and filtered out by `search_parameters`. The graph is
+    rebuilt from the live vectors once deleted ones exceed TOMBSTONE_REBUILD_RATIO.
+    """
+    ids = np.asarray(list(ids), dtype=np.int64)
+    if len(ids) == 0:
+        return index
+    if params["index_type"] != "hnsw":
+        index.remove_ids(faiss.IDSelectorBatch(ids))
+        return index
+    deleted = np.union1d(params.get("deleted", []), ids).astype(np.int64)
+    if len(deleted) <= TOMBSTONE_REBUILD_RATIO * index.ntotal:
+        params["deleted"] = deleted.tolist()
+        return index
+    params.pop("deleted", None)
+    keep = np.setdiff1d(faiss.vector_to_array(index.id_map), deleted)
+    if not len(keep):
+        return wrap_with_ids(empty_flat_index(index.d, params["metric"]))
+    return build_index(index.reconstruct_batch(keep), params, keep)
+
+
+def undelete_ids(params, ids):
+    """Take `ids` out of the deleted IDs of an HNSW graph; returns a mask of those that were deleted.
+
+    Their vectors are still in the graph, so they are live again without being re-added.
+    """
+    deleted = params.get("deleted")
+    if not deleted:
+        return np.zeros(len(ids), dtype=bool)
+    ids = np.asarray(ids, dtype=np.int64)
+    revived = np.isin(ids, deleted)
+    if revived.any():
+        params["deleted"] = np.setdiff1d(deleted, ids[revived]).tolist()
+    return revived
+
+
+def search_parameters(params):
+    """Search parameters hiding deleted vectors of an HNSW graph, or None when nothing is deleted"""
+    deleted = params.get("deleted")
+    if not deleted or params.get("index_type") != "hnsw":
+        return None
+    batch = faiss.IDSelectorBatch(np.asarray(deleted, dtype=np.int64))
+    selector = faiss.IDSelectorNot(batch)
+    search_params = faiss.SearchParametersHNSW(sel=selector, efSearch=params["efSearch"])
+    search_params.selectors = (batch, selector)  # SWIG objects do not keep the selectors they point to alive
+    return search_params
+
+
+def apply_search_params(index, params):
+    """Restore the query-time knobs that are not stored in the .index file"""
+    index_type = params.get("index_type", "flat")
+    if index_type == "hnsw":
+        base_index(index).hnsw.efSearch = params["efSearch"]
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+
+
+def bytes_per_vector(index):
+    if index.ntotal == 0:
+        return 0.0
+    return faiss.serialize_index(index).nbytes / index.ntotal
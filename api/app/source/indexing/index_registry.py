@@ -0,0 +1,122 @@
+import asyncio
+import os
+from collections import OrderedDict
+from pathlib import Path
+from .indexing_manager import IndexingManager
+from .indexing_tree import sanitize_url
+
+
+class IndexRegistry:
+    """Indexes available to this worker, backed by the data/websites/<sanitized_url> layout.
+
+    Indexes are loaded lazily from disk on first use and kept in an LRU bounded
+    by the size of their index files. Every lookup compares the manifest
+    modification time with the one seen at load time, so an index rebuilt by
+    another worker (or before a restart) is picked up without coordination.
+    """
+
+    def __init__(self, root=Path("data") / "websites", max_bytes=2 * 1024 ** 3, max_entries=32, **manager_kwargs):
+        self.root = Path(root)
+        self.manager_kwargs = manager_kwargs  # Passed to every IndexingManager loaded from disk
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # sanitized_url -> (manager, manifest_mtime, size)
+        self._locks = {}  # sanitized_url -> [lock, number of requests using it], only while loading
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(float(os.getenv("INDEX_CACHE_MAX_MB", "2048")) * 1024 ** 2),
+            max_entries=int(os.getenv("INDEX_CACHE_MAX_ENTRIES", "32")),
+        )
+
+    def _manifest_path(self, sanitized_url):
+        return self.root / sanitized_url / "main_index.manifest.json"
+
+    def _manifest_mtime(self, sanitized_url):
+        try:
+            return os.path.getmtime(self._manifest_path(sanitized_url))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _resident_size(manager):
+        """Approximate RAM held by a loaded index (the chunk store is mmapped, so it is not counted)"""
+        index_path = manager.index_dir / "main_index.index"
+        return os.path.getsize(index_path) if index_path.exists() else 0
+
+    def exists(self, url):
+        return self._manifest_mtime(sanitize_url(url)) is not None
+
+    async def get(self, url):
+        """Return the IndexingManager for `url`, loading it from disk if needed; None if not indexed"""
+        sanitized_url = sanitize_url(url)
+        mtime = self._manifest_mtime(sanitized_url)
+        if mtime is None:
+            return None
+
+        entry = self._entries.get(sanitized_url)
+        if entry is not None and entry[1] == mtime:
+            self._entries.move_to_end(sanitized_url)
+            self.hits += 1
+            return entry[0]
+
+        lock = self._locks.setdefault(sanitized_url, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                # Another request may have loaded it while we waited
+                entry = self._entries.get(sanitized_url)
+                if entry is not None and entry[1] == mtime:
+                    self._entries.move_to_end(sanitized_url)
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+                manager = IndexingManager(url, **self.manager_kwargs)
+                if not await manager.load():
+                    return None
+                self._put(sanitized_url, manager, mtime)
+                return manager
+        finally:
+            lock[1] -= 1
+            if not lock[1]:
+                # Last request for this URL: don't keep a lock per URL ever asked for
+                del self._locks[sanitized_url]
+
+    def version(self, url):
+        """Manifest mtime of the loaded index for `url`, which changes whenever it is rebuilt"""
+        entry = self._entries.get(sanitize_url(url))
+        return None if entry is None else entry[1]
+
+    def register(self, manager):
+        """Add an index this worker just built"""
+        self._put(manager.sanitized_url, manager, self._manifest_mtime(manager.sanitized_url))
+
+    def _put(self, sanitized_url, manager, mtime):
+        previous = self._entries.pop(sanitized_url, None)
+        if previous is not None and previous[0] is not manager:
+            previous[0].embedding_manager.close()
+        self._entries[sanitized_url] = (manager, mtime, self._resident_size(manager))
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self.resident_bytes() > self.max_bytes
+        ):
+            sanitized_url, (manager, _, _) = self._entries.popitem(last=False)
+            print(f"Evicting index {sanitized_url} from memory")
+            manager.embedding_manager.close()
+
+    def resident_bytes(self):
+        return sum(size for _, _, size in self._entries.values())
+
+    def stats(self):
+        return {
+            "loaded": list(self._entries),
+            "resident_bytes": self.resident_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,35 +1,88 @@
 import asyncio
+import time
 from pathlib import Path
-from .chunker import build_chunks_from_tree
-from .embedder import EmbeddingManager
+from .chunker import Chunker
 from .indexing_tree import LinkTree, sanitize_url
+from ..telemetry import span, traced
 
 class IndexingManager:
-    def __init__(self, url, model_name="all-mpnet-base-v2", chunk_size=384, max_depth=1):
+    def __init__(self, url, model_name="all-mpnet-base-v2", chunk_size=256, max_depth=1,
+                 crawl_workers=8, crawl_time_budget=200, embed_batch_size=64, max_pending_batches=4,
+                 rebuild=False, index_type="auto", executor=None, max_page_age=None):
         self.url = url
         self.model_name = model_name
-        self.chunk_size = chunk_size
+        self.chunk_size = chunk_size  # In tokens of the embedding model, capped by its input window
         self.max_depth = max_depth
+        self.crawl_workers = crawl_workers
+        self.crawl_time_budget = crawl_time_budget
+        self.embed_batch_size = embed_batch_size
+        self.max_pending_batches = max_pending_batches
+        self.rebuild = rebuild  # Ignore the saved index and build a fresh one
+        self.executor = executor  # Bounded executor for CPU-heavy stages (None: loop default)
+        # Cached pages older than this (seconds) are revalidated; a rebuild revalidates every page
+        self.max_page_age = 0 if rebuild else max_page_age
         self.sanitized_url = sanitize_url(url)
         self.index_dir = Path('data') / "websites" / self.sanitized_url
+        from .embedder import EmbeddingManager  # Imports faiss, kept out of the API startup
         self.embedding_manager = EmbeddingManager(
             model_name=model_name,
-            index_dir=str(self.index_dir))
+            index_dir=str(self.index_dir),
+            index_type=index_type)
         self.tree = None
         self.chunks = None
+        self.chunk_metadata = None
+        self.loaded = False
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.started_at = None
+        self.finished_at = None
 
-    @staticmethod
-    def build_starting_prompt(context_chunks, query):
-        base_prompt = '''Using the information below, answer any question the user might have about this topic. If the answer cannot be found, write
+    BASE_PROMPT = '''Using the information below, answer any question the user might have about this topic. If the answer cannot be found, write
 "I'm sorry, but I couldn't find the answer."
 '''
-        for chunk in context_chunks:
-            base_prompt += f"\nInformation: {chunk}"
-        return base_prompt + f"\nUser question: {query}\nAnswer clearly and concisely."
+
+    @staticmethod
+    def format_chunk(chunk, source=None):
+        if source and source.get('url'):
+            return f"\nInformation (source: {source['url']}): {chunk}"
+        return f"\nInformation: {chunk}"
+
+    @staticmethod
+    def format_question(query):
+        return f"\nUser question: {query}\nAnswer clearly and concisely."
+
+    @classmethod
+    def build_context_prompt(cls, context_chunks, query, sources=None):
+        """The per-question part of the prompt: retrieved chunks and the question"""
+        sources = sources if sources is not None else [None] * len(context_chunks)
+        prompt = "".join(cls.format_chunk(chunk, source) for chunk, source in zip(context_chunks, sources))
+        return prompt + cls.format_question(query)
+
+    @classmethod
+    def build_starting_prompt(cls, context_chunks, query, sources=None):
+        return cls.BASE_PROMPT + cls.build_context_prompt(context_chunks, query, sources)
+
+    def index_settings(self):
+        """Settings that must match for a saved index to be reused"""
+        return {"chunker": "structure", "chunk_size": self.chunk_size}
+
+    def make_chunker(self):
+        """Chunker sized in tokens of the embedding model (loads the model)"""
+        max_tokens = min(self.chunk_size, self.embedding_manager.max_input_tokens(self.chunk_size))
+        return Chunker(self.embedding_manager.token_counter(), max_tokens=max_tokens)
+
+    @traced("index.load")
+    async def load(self):
+        """Load the saved index and chunk store instead of crawling; False if none matches"""
+        loop = asyncio.get_event_loop()
+        self.loaded = await loop.run_in_executor(
+            self.executor, self.embedding_manager.load_from_disk, "main_index", self.index_settings()
+        )
+        return self.loaded
 
     async def __call__(self, query=None):
         # Run full pipeline if not already executed
-        if not self.tree:
+        if not self.tree and not self.loaded:
             await self._execute_pipeline()
 
         # Handle query if provided
@@ -38,29 +91,108 @@ class IndexingManager:
         
         return self.embedding_manager.index
 
+    @traced("index.pipeline")
     async def _execute_pipeline(self):
-        """Run all processing steps"""
-        self.tree = LinkTree(self.url, max_depth=self.max_depth)
-        await self.tree.build_tree()
-        
-        # Generate chunks
+        """Run all processing steps.
+
+        Pages are chunked in queue order as soon as their crawl level is
+        fetched, and chunks are embedded in bounded batches while the crawl is
+        still running. An existing index
+        built with the same settings is updated incrementally.
+        """
         loop = asyncio.get_event_loop()
-        self.chunks = await loop.run_in_executor(
-            None, build_chunks_from_tree, self.tree, self.chunk_size
-        )
-        
-        # Create/save index
+        self.started_at = time.monotonic()
+        settings = self.index_settings()
+        batches = asyncio.Queue(maxsize=self.max_pending_batches)
+        pending_chunks, pending_metadata = [], []
+        # One chunker per run: it remembers boilerplate blocks already seen on other pages
+        chunker = await loop.run_in_executor(self.executor, self.make_chunker)
+
+        async def put_batch(batch):
+            # Blocks the crawl when embedding falls behind, but not once embedding has died:
+            # then nothing reads the queue any more and its error is raised instead
+            put = asyncio.ensure_future(batches.put(batch))
+            try:
+                await asyncio.wait({put, embed_task}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not put.done():
+                    put.cancel()
+            if not put.done() or put.cancelled():
+                embed_task.result()
+                raise RuntimeError("Embedding stopped before all chunks were queued")
+
+        async def on_page(node):
+            with span("index.chunk_page"):
+                chunks, metadata = await loop.run_in_executor(self.executor, chunker.chunk_page, node)
+            self.chunks_total += len(chunks)
+            pending_chunks.extend(chunks)
+            pending_metadata.extend(metadata)
+            while len(pending_chunks) >= self.embed_batch_size:
+                batch = (pending_chunks[:self.embed_batch_size], pending_metadata[:self.embed_batch_size])
+                del pending_chunks[:self.embed_batch_size], pending_metadata[:self.embed_batch_size]
+                await put_batch(batch)
+
+        async def embed_batches():
+            while (batch := await batches.get()) is not None:
+                with span("index.embed_batch", chunks=len(batch[0])):
+                    await loop.run_in_executor(self.executor, self.embedding_manager.add_to_index, *batch)
+                self.chunks_embedded += len(batch[0])
+
         await loop.run_in_executor(
-            None, self.embedding_manager.generate_index_from_chunks, self.chunks, "main_index"
+            self.executor, self.embedding_manager.start_streaming_index, "main_index", settings, self.rebuild
         )
+        embed_task = asyncio.create_task(embed_batches())
+        self.tree = LinkTree(self.url, max_depth=self.max_depth, workers=self.crawl_workers,
+                             time_budget=self.crawl_time_budget, on_page=on_page, executor=self.executor,
+                             max_page_age=self.max_page_age)
+        try:
+            with span("index.crawl", url=self.url):
+                await self.tree.build_tree()
+            if pending_chunks:
+                await put_batch((pending_chunks[:], pending_metadata[:]))
+            await put_batch(None)
+            await embed_task
+        except BaseException:
+            embed_task.cancel()
+            raise
+
+        # Drop stale vectors and save index + manifest
+        with span("index.finish"):
+            await loop.run_in_executor(
+                self.executor, self.embedding_manager.finish_streaming_index, "main_index", settings,
+                self.tree.complete, self.tree.gone_urls
+            )
+        print(f"Chunking dropped {chunker.duplicates_dropped} duplicate blocks")
+        self.chunks = self.embedding_manager.chunks
+        self.chunk_metadata = self.embedding_manager.chunk_metadata
+        self.finished_at = time.monotonic()
+
+    def progress(self):
+        """Pages crawled, chunks embedded and a rough ETA of the running pipeline"""
+        pages_crawled = self.tree.pages_crawled if self.tree else 0
+        pages_scheduled = self.tree.pages_scheduled if self.tree else 0
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at if self.started_at else 0.0
+        eta = None
+        if pages_crawled and self.chunks_embedded:
+            crawl_left = elapsed / pages_crawled * max(pages_scheduled - pages_crawled, 0)
+            embed_left = elapsed / self.chunks_embedded * max(self.chunks_total - self.chunks_embedded, 0)
+            eta = round(max(crawl_left, embed_left), 1)
+        return {
+            "pages_crawled": pages_crawled,
+            "pages_scheduled": pages_scheduled,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "elapsed_seconds": round(elapsed, 1),
+            "eta_seconds": eta,
+        }
 
     async def _handle_query(self, query):
         """Process user query and generate response"""
         loop = asyncio.get_event_loop()
-        similarities, results = await loop.run_in_executor(
-            None, self.embedding_manager.search_index, [query], 5
+        similarities, results, sources = await loop.run_in_executor(
+            None, self.embedding_manager.search_index_with_sources, [query], 5
         )
-        return self.build_starting_prompt(results[0], query)
+        return self.build_starting_prompt(results[0], query, sources[0])
     
     async def close(self):
         """Cleanup resources"""
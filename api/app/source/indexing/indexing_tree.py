@@ -1,91 +1,300 @@
-from trafilatura import fetch_url, extract
+from copy import deepcopy
 from urllib.parse import urljoin, urlparse
 from collections import deque
 
 
 import re
-import hashlib
-import json
-import aiofiles
-import os
+import time
 
-from asyncio import to_thread, get_event_loop, sleep
+from asyncio import to_thread, get_event_loop, gather, create_task, Semaphore, timeout
 from pathlib import Path
-from gzip import decompress, compress
+from .crawler import CrawlSession
+from .page_store import NOT_STORED, open_page_store
 
 
+def extract_links_from_tree(body, base_url):
+    """Collect outgoing links from the `ref` elements of a trafilatura tree."""
+    links = []
+    for ref in body.iter("ref"):
+        target = ref.get("target", "")
+        if not target or target.startswith("#") or target.startswith(f"{base_url}#"):
+            continue
+        links.append(urljoin(base_url, target))
+    return links
+
+def extract_info_from_html(download, base_url=""):
+    """Parse the page once and return its link-bearing HTML, plain text and outgoing links."""
+    # trafilatura is only imported once something is crawled, not when the API starts
+    from trafilatura import bare_extraction
+    from trafilatura.htmlprocessing import build_html_output
+    from trafilatura.utils import normalize_unicode
+    from trafilatura.xml import xmltotxt
+    from lxml.etree import strip_tags
+    document = bare_extraction(download, fast=True, include_comments=False, include_tables=True, include_links=True)
+    if document is None or document.body is None:
+        return None, None, []
+    links       = extract_links_from_tree(document.body, base_url)
+    # Plain text without the link markup, taken from a copy of the (small) extracted tree
+    text_body   = deepcopy(document.body)
+    strip_tags(text_body, "ref")
+    text_info   = normalize_unicode(xmltotxt(text_body, False))
+    # Converting to HTML rewrites the tree in place, so it has to come last
+    html_info   = build_html_output(document)
+    return html_info, text_info, links
+
 def extract_info_from_website(url):
+    from trafilatura import fetch_url
     download    = fetch_url(url)
-    html_info   = extract(download, output_format="html",include_links=True, include_comments=False, include_tables=False, no_fallback=True)
-    text_info   = extract(download, include_comments=False, include_tables=True, no_fallback=True)
-    return html_info, text_info
+    return extract_info_from_html(download, url)
 
 class LinkNode:
     def __init__(self, url, depth=0, parent=None):
         self.url = url
         self.html_text = ""
         self.text = ""
+        self.links = None
         self.children = []
         self.depth = depth
         self.parent = parent
+        self.gone = False  # The page answered 404/410 and was dropped from the page store
+
+    def load_record(self, record):
+        self.text = record.get('text') or ''
+        self.html_text = record.get('html_text') or ''
+        self.links = record.get('links')
+
+    async def populate_text(self, session=None, executor=None, page_store=None, record=None, max_age=None):
+        """Fill the node from the page store or by fetching it.
+
+        `record` is the stored page if the caller already bulk-loaded it, or
+        NOT_STORED if the bulk load did not find it. A stored
+        page older than `max_age` seconds is revalidated with a conditional
+        request. If revalidation fails (timeout, 429, 5xx...) the stored copy
+        is used unchanged; only a 404/410 removes it. Returns the record to
+        write back to the store, or None if the stored one is still current.
+        Without a `page_store`, the node's own site store is used and written
+        immediately.
+        """
+        store = page_store or open_page_store(self.url)
+        try:
+            if record is None:
+                record = (await to_thread(store.get_many, [self.url])).get(self.url)
+            elif record is NOT_STORED:
+                record = None
+            fresh = record is not None and (
+                max_age is None or session is None or time.time() - (record.get('fetched_at') or 0) <= max_age
+            )
+            if fresh:
+                self.load_record(record)
+                return None
 
-    async def populate_text(self):
-        data_path = get_data_path(self.url)
-        data_dir = data_path.parent
-        if not await to_thread(os.path.exists, data_dir):
-            await to_thread(os.makedirs, data_dir, exist_ok=True)
-
-        if await data_exists(self.url):
-            data = await load_data(self.url)
-            self.text = data.get('text', '')
-            self.html_text = data.get('html_text', '')
-        else:
             loop = get_event_loop()
-            html_text, page_text = await loop.run_in_executor(None, extract_info_from_website, self.url)
+            validators = {}
+            if session is None:
+                html_text, page_text, links = await loop.run_in_executor(executor, extract_info_from_website, self.url)
+                if html_text is None and record is not None:
+                    # Download failed: keep the stored copy
+                    self.load_record(record)
+                    return None
+            else:
+                try:
+                    result = await session.fetch_page(
+                        self.url,
+                        etag=record.get('etag') if record else None,
+                        last_modified=record.get('last_modified') if record else None,
+                    )
+                except Exception:
+                    if record is None:
+                        raise
+                    result = None
+                if result is not None and result.gone:
+                    self.gone = True
+                    await to_thread(store.delete_many, [self.url])
+                    return None
+                if record is not None and (result is None or result.status not in (200, 304)):
+                    # Possibly transient failure: keep serving the stored copy and retry next crawl
+                    print(f"Revalidating {self.url} failed ({result.status if result else 'error'}), using the stored copy")
+                    self.load_record(record)
+                    return None
+                if result.not_modified and record is not None:
+                    self.load_record(record)
+                    new_record = dict(record, fetched_at=time.time())
+                    if page_store is None:
+                        await to_thread(store.put_many, [new_record])
+                    return new_record
+                validators = {'etag': result.etag, 'last_modified': result.last_modified}
+                html_text, page_text, links = (None, None, [])
+                if result.text:
+                    html_text, page_text, links = await loop.run_in_executor(
+                        executor, extract_info_from_html, result.text, self.url
+                    )
             self.text = page_text or ''
             self.html_text = html_text or ''
-            await save_data(self.url, {'text': self.text, 'html_text': self.html_text})
+            self.links = links
+            new_record = {'url': self.url, 'text': self.text, 'html_text': self.html_text, 'links': self.links,
+                          'fetched_at': time.time(), **validators}
+            if page_store is None:
+                await to_thread(store.put_many, [new_record])
+            return new_record
+        finally:
+            if page_store is None:
+                store.close()
 
 class LinkTree:
-    def __init__(self, root_url, max_depth=3):
+    def __init__(self, root_url, max_depth=3, workers=8, per_host_concurrency=2,
+                 min_host_delay=0.25, time_budget=None, on_page=None, executor=None,
+                 page_store=None, max_page_age=None):
         self.root = LinkNode(root_url)
         self.max_depth = max_depth
         self.visited = {root_url}
         self.queue = deque([self.root])
+        self.workers = workers
+        self.per_host_concurrency = per_host_concurrency
+        self.min_host_delay = min_host_delay
+        self.time_budget = time_budget
+        self.on_page = on_page  # Optional coroutine called with each populated node, in queue order
+        self.timed_out = False
+        self.failed_urls = set()  # Pages that could not be fetched (and had no stored copy) or came back empty
+        self.gone_urls = set()  # Pages that answered 404/410
+        self.executor = executor  # Executor for CPU-bound extraction (None: loop default)
+        self.pages_scheduled = 0
+        self.pages_crawled = 0
+        self.page_store = page_store  # Opened for the root URL's site when the crawl starts
+        self.max_page_age = max_page_age  # Stored pages older than this (seconds) are revalidated
+        self._unsaved = []  # Records fetched during the current level, written in one batch
+        self._level = []  # Nodes of the level being fetched
+        self._delivery = None  # Task passing fetched levels to on_page
 
     def extract_links(self, html, base_url):
         pattern = r'href="(?!{}#|#)([^"]+)"'.format(re.escape(base_url))
         links = re.findall(pattern, html)
         return [urljoin(base_url, link) for link in links]
 
-    async def build_tree(self):
-        while self.queue:
-            current_node = self.queue.popleft()
-            
-            if current_node.depth >= self.max_depth:
-                continue
+    async def _populate_node(self, node, session, semaphore, record=None):
+        async with semaphore:
             try:
-                await current_node.populate_text()
+                new_record = await node.populate_text(
+                    session, self.executor, self.page_store, record, self.max_page_age
+                )
+                if new_record is not None:
+                    self._unsaved.append(new_record)
             except Exception as e:
-                print(f"Error processing {current_node.url}: {e}")
+                print(f"Error processing {node.url}: {e}")
                 print("Information might be missing...")
-                continue
-            if not current_node.html_text:
-                print(f"No HTML content for {current_node.url}.")
-                continue
-            
+                self.failed_urls.add(node.url)
+                return False
+            finally:
+                self.pages_crawled += 1
+        if node.gone:
+            self.gone_urls.add(node.url)
+        elif not node.text:
+            self.failed_urls.add(node.url)
+        if not node.html_text:
+            print(f"No HTML content for {node.url}.")
+            return False
+        return True
+
+    def _expand_node(self, current_node):
+        child_links = current_node.links
+        if child_links is None:
+            # Pages cached before links were stored alongside the text
             child_links = self.extract_links(current_node.html_text, current_node.url)
-            
-            for link in child_links:
-                if link not in self.visited:
-                    self.visited.add(link)
-                    child_node = LinkNode(
-                       url=link,
-                        depth=current_node.depth + 1,
-                        parent=current_node
-                    )
-                    current_node.children.append(child_node)
-                    self.queue.append(child_node)
+
+        for link in child_links:
+            if link not in self.visited:
+                self.visited.add(link)
+                child_node = LinkNode(
+                    url=link,
+                    depth=current_node.depth + 1,
+                    parent=current_node
+                )
+                current_node.children.append(child_node)
+                self.queue.append(child_node)
+
+    async def _crawl_levels(self, session):
+        """Crawl the queue one BFS level at a time, fetching each level concurrently.
+
+        Children are only discovered once their whole level has been fetched and
+        in queue order, so depths and `visited` match a serial BFS crawl.
+        """
+        semaphore = Semaphore(self.workers)
+        while self.queue:
+            level = [node for node in self.queue if node.depth < self.max_depth]
+            self.queue.clear()
+            if not level:
+                break
+            self.pages_scheduled += len(level)
+            self._level = level
+            # Bulk-load the stored pages of the whole level in one query
+            records = await to_thread(self.page_store.get_many, [node.url for node in level])
+            populated = await gather(*(
+                self._populate_node(node, session, semaphore, records.get(node.url, NOT_STORED)) for node in level
+            ))
+            await self._save_pages()
+            self._deliver(level)
+            for node, ok in zip(level, populated):
+                if ok:
+                    self._expand_node(node)
+
+    def _deliver(self, level):
+        """Pass a fetched level to `on_page` in queue order while the next level is fetched.
+
+        Pages finish fetching in a different order on every crawl; handing them
+        over in queue order keeps what `on_page` does with them (e.g. which page
+        keeps a block repeated across pages) the same from one crawl to the next.
+        """
+        self._level = []
+        if self.on_page is None:
+            return
+        previous = self._delivery
+        if previous is not None and previous.done():
+            previous.result()  # Stop crawling once on_page has failed
+
+        async def deliver():
+            if previous is not None:
+                await previous
+            for node in level:
+                if node.text:
+                    await self.on_page(node)
+
+        self._delivery = create_task(deliver())
+
+    async def _save_pages(self):
+        records, self._unsaved = self._unsaved, []
+        if records:
+            await to_thread(self.page_store.put_many, records)
+
+    async def build_tree(self):
+        owns_store = self.page_store is None
+        if owns_store:
+            self.page_store = await to_thread(open_page_store, self.root.url)
+        try:
+            async with CrawlSession(self.workers, self.per_host_concurrency, self.min_host_delay) as session:
+                try:
+                    async with timeout(self.time_budget):
+                        await self._crawl_levels(session)
+                except TimeoutError:
+                    # Pending fetches were cancelled; keep whatever was crawled so far
+                    print(f"Crawl time budget of {self.time_budget}s exhausted, stopping early.")
+                    self.timed_out = True
+                    self.queue.clear()
+                    # Pages of the interrupted level that were fetched in time are still used
+                    self._deliver([node for node in self._level if node.text])
+                finally:
+                    await self._save_pages()
+                    if owns_store:
+                        self.page_store.close()
+                        self.page_store = None
+            if self._delivery is not None:
+                await self._delivery
+        finally:
+            if self._delivery is not None:
+                self._delivery.cancel()  # No-op once done; stops delivery if the crawl failed
+
+    @property
+    def complete(self):
+        """Every reachable page was crawled: pages missing from the crawl are really gone"""
+        return not self.timed_out and not self.failed_urls
 
     def print_tree(self):
         self._print_node(self.root)
@@ -107,50 +316,6 @@ def sanitize_url(url):
     sanitized = re.sub(r'[^a-zA-Z0-9_\-\.]', '_', sanitized)  # Replace any other special characters with underscores
     return sanitized
 
-def get_data_path(url):
-    """Generate a safe file path based on the sanitized URL."""
-    sanitized_url = sanitize_url(url)
-    hashed = hashlib.sha256(url.encode()).hexdigest()
-    return Path('data') / "websites" / sanitized_url / f'{hashed}.json.gz'
-
-async def data_exists(url):
-    data_path = get_data_path(url)
-    return await to_thread(os.path.exists, data_path)
-
-async def load_data(url):
-    '''Loads data using alternate threads to stop blocking behaviour.'''
-    data_path = get_data_path(url)
-    async with aiofiles.open(data_path, 'rb') as f:
-        compressed_data = await f.read()
-    data_bytes = await to_thread(decompress, compressed_data)
-    return json.loads(data_bytes.decode('utf-8'))
-
-async def save_data(url, data):
-    data_path = get_data_path(url)
-    lock_path = data_path.with_suffix('.lock')
-    
-    # Create lock file
-    while True:
-        try:
-            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL)
-            os.close(fd)
-            break
-        except FileExistsError:
-            await sleep(0.1)
-    
-    try:
-        # Compress in thread to avoid blocking
-        data_str = json.dumps(data)
-        data_bytes = data_str.encode('utf-8')
-        compressed_data = await to_thread(compress, data_bytes)
-        
-        async with aiofiles.open(data_path, 'wb') as f:
-            await f.write(compressed_data)
-    finally:
-        try:
-            os.remove(lock_path)
-        except:
-            pass
 async def build_index_from_url(url, depth = 1):
     index_tree = LinkTree(url, max_depth = depth)
     await index_tree.build_tree()
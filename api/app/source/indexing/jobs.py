@@ -0,0 +1,185 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from .indexing_manager import IndexingManager
+from .indexing_tree import sanitize_url
+from ..telemetry import InstrumentedExecutor
+
+
+class IndexingJob:
+    """One background run of the indexing pipeline for a URL."""
+
+    def __init__(self, url, manager):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.sanitized_url = sanitize_url(url)
+        self.manager = manager
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "url": self.url,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            **self.manager.progress(),
+        }
+
+
+class JobManager:
+    """Runs indexing pipelines in the background, one per sanitized URL.
+
+    CPU-heavy stages (extraction, chunking, embedding) share one bounded
+    executor, so indexing cannot take every thread of the API worker. A job
+    that is already running for a URL is returned instead of starting a
+    second crawl. Across uvicorn workers, the same is done with an flock on
+    `data/websites/<sanitized_url>/job.lock`. Progress is mirrored to `job.json`
+    next to it, so any worker can answer status requests.
+    """
+
+    def __init__(self, root=Path("data") / "websites", cpu_workers=2, status_interval=2.0, max_page_age=None):
+        self.root = Path(root)
+        self.executor = InstrumentedExecutor("indexing", max_workers=cpu_workers)
+        self.status_interval = status_interval
+        self.max_page_age = max_page_age  # Passed to every IndexingManager (None: never revalidate)
+        self.jobs = {}  # sanitized_url -> IndexingJob (latest)
+        self.on_finished = None  # Optional callback(manager) once an index is saved
+
+    @classmethod
+    def from_env(cls):
+        max_page_age = os.getenv("PAGE_MAX_AGE")
+        return cls(
+            cpu_workers=int(os.getenv("INDEXING_CPU_WORKERS", "2")),
+            max_page_age=float(max_page_age) if max_page_age else None,
+        )
+
+    def _status_path(self, sanitized_url):
+        return self.root / sanitized_url / "job.json"
+
+    def _write_status(self, job):
+        path = self._status_path(job.sanitized_url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+        tmp_path.write_text(json.dumps(job.to_dict()))
+        os.replace(tmp_path, path)
+
+    def _try_lock(self, sanitized_url):
+        """Take the cross-worker job lock for a URL, or return None if another worker holds it"""
+        lock_path = self.root / sanitized_url / "job.lock"
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = open(lock_path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _lock_held(self, sanitized_url):
+        """Whether any worker, this one included, holds the job lock for a URL"""
+        lock_file = self._try_lock(sanitized_url)
+        if lock_file is None:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+        return False
+
+    def submit(self, url, **manager_kwargs):
+        """Start indexing `url` unless a job for it is already running; returns the job status"""
+        sanitized_url = sanitize_url(url)
+        job = self.jobs.get(sanitized_url)
+        if job is not None and job.status in ("queued", "running"):
+            return job.to_dict()
+
+        lock_file = self._try_lock(sanitized_url)
+        if lock_file is None:
+            # Another worker is indexing this URL; report its progress, not a job this worker finished
+            status = self._read_status(sanitized_url)
+            if status is None or status["status"] not in ("queued", "running"):
+                # It holds the lock but has not written its status yet
+                status = {"job_id": None, "url": url, "status": "queued", "error": None,
+                          "created_at": time.time(), "finished_at": None}
+            return status
+
+        manager = IndexingManager(url, executor=self.executor, max_page_age=self.max_page_age, **manager_kwargs)
+        job = IndexingJob(url, manager)
+        self.jobs[sanitized_url] = job
+        self._write_status(job)
+        job.task = asyncio.create_task(self._run(job, lock_file))
+        return job.to_dict()
+
+    async def _run(self, job, lock_file):
+        reporter = asyncio.create_task(self._report(job))
+        try:
+            job.status = "running"
+            await job.manager()
+            job.status = "done"
+            if self.on_finished is not None:
+                self.on_finished(job.manager)
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            job.error = "Indexing was cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"Indexing {job.url} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            reporter.cancel()
+            self._write_status(job)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    async def _report(self, job):
+        while True:
+            self._write_status(job)
+            await asyncio.sleep(self.status_interval)
+
+    def status(self, url):
+        """Latest job status for `url`, from this worker or from the on-disk status file"""
+        sanitized_url = sanitize_url(url)
+        job = self.jobs.get(sanitized_url)
+        if job is not None and job.status in ("queued", "running"):
+            return job.to_dict()
+        status = self._read_status(sanitized_url)
+        if job is not None and (status is None or status["job_id"] == job.id
+                                or status["created_at"] <= job.created_at):
+            return job.to_dict()
+        # A newer job started on another worker after this one's finished
+        return status
+
+    def _read_status(self, sanitized_url):
+        path = self._status_path(sanitized_url)
+        if not path.exists():
+            return None
+        status = json.loads(path.read_text())
+        if status["status"] in ("queued", "running") and not self._lock_held(sanitized_url):
+            # The worker running the job died without recording how it ended
+            status.update(status="cancelled", error="Indexing stopped before it finished")
+        return status
+
+    async def wait(self, url):
+        """Wait until the job for `url` finishes, polling the status file if another worker runs it"""
+        job = self.jobs.get(sanitize_url(url))
+        if job is not None and job.task is not None and not job.task.done():
+            await asyncio.wait({job.task})  # Unlike awaiting it, does not raise if the job was cancelled
+            return
+        while (status := self.status(url)) is not None and status["status"] in ("queued", "running"):
+            await asyncio.sleep(self.status_interval)
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
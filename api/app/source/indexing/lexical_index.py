@@ -0,0 +1,104 @@
+import json
+import math
+import os
+import re
+import numpy as np
+from collections import Counter
+from pathlib import Path
+
+
+POSTING_DTYPE = np.dtype([("id", np.int64), ("weight", np.float32)])
+
+_TOKEN_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+
+
+def tokenize(text):
+    """Lowercased terms; compound terms such as `abc-123` or `os.path` also yield their parts"""
+    terms = []
+    for token in _TOKEN_RE.findall(str(text).lower()):
+        terms.append(token)
+        parts = re.split(r"[-./:]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    return terms
+
+
+class BM25Index:
+    """Inverted BM25 index over the chunks of a site, persisted next to the FAISS index.
+
+    Each term maps to a slice of one postings array holding (chunk ID, BM25
+    weight) pairs. Weights are computed when the index is built, and each
+    slice is sorted by weight, highest first. A query only reads the first
+    `max_postings` entries of each of its terms, so scoring cost depends on
+    the number of query terms, not on the number of chunks.
+    """
+
+    def __init__(self, index_dir, name, k1=1.2, b=0.75):
+        self.postings_path = Path(index_dir) / f"{name}.bm25.postings.npy"
+        self.offsets_path = Path(index_dir) / f"{name}.bm25.offsets.npy"
+        self.vocab_path = Path(index_dir) / f"{name}.bm25.vocab.json"
+        self.k1 = k1
+        self.b = b
+        self.vocab = None
+        self.offsets = None
+        self.postings = None
+
+    def exists(self):
+        return all(path.exists() for path in (self.postings_path, self.offsets_path, self.vocab_path))
+
+    def build(self, ids, texts):
+        """Compute the postings of every chunk and write the index atomically"""
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        avg_length = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        norms = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+
+        term_postings = {}
+        for chunk_id, chunk_counts, norm in zip(ids, counts, norms):
+            for term, tf in chunk_counts.items():
+                term_postings.setdefault(term, []).append((int(chunk_id), tf * (self.k1 + 1) / (tf + norm)))
+
+        vocab = {}
+        offsets = [0]
+        postings = []
+        for term_number, (term, entries) in enumerate(sorted(term_postings.items())):
+            idf = math.log(1 + (len(counts) - len(entries) + 0.5) / (len(entries) + 0.5))
+            entries.sort(key=lambda entry: -entry[1])
+            postings.extend((chunk_id, weight * idf) for chunk_id, weight in entries)
+            vocab[term] = term_number
+            offsets.append(len(postings))
+
+        tmp_suffix = f".tmp{os.getpid()}"
+        with open(f"{self.postings_path}{tmp_suffix}", "wb") as f:
+            np.save(f, np.array(postings, dtype=POSTING_DTYPE))
+        with open(f"{self.offsets_path}{tmp_suffix}", "wb") as f:
+            np.save(f, np.array(offsets, dtype=np.int64))
+        with open(f"{self.vocab_path}{tmp_suffix}", "w") as f:
+            json.dump(vocab, f)
+        for path in (self.postings_path, self.offsets_path, self.vocab_path):
+            os.replace(f"{path}{tmp_suffix}", path)
+        return self.open()
+
+    def open(self):
+        self.postings = np.load(self.postings_path, mmap_mode="r")
+        self.offsets = np.load(self.offsets_path)
+        with open(self.vocab_path) as f:
+            self.vocab = json.load(f)
+        return self
+
+    def search(self, query, k=10, max_postings=1000):
+        """Return (scores, ids) of the `k` best chunks for `query`, best first"""
+        slices = []
+        for term in set(tokenize(query)):
+            term_number = self.vocab.get(term)
+            if term_number is not None:
+                start = self.offsets[term_number]
+                end = min(self.offsets[term_number + 1], start + max_postings)
+                slices.append(self.postings[start:end])
+        if not slices:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        postings = np.concatenate(slices)
+        ids, inverse = np.unique(postings["id"], return_inverse=True)
+        scores = np.bincount(inverse, weights=postings["weight"]).astype(np.float32)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return scores[top], ids[top]
@@ -0,0 +1,196 @@
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from gzip import compress as gzip_compress, decompress as gzip_decompress
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:  # zlib is used instead
+    zstandard = None
+
+
+# Passed as the stored record of a page the caller looked up in bulk and did not find
+NOT_STORED = object()
+
+
+def _site_dir(url):
+    from .indexing_tree import sanitize_url
+    return Path("data") / "websites" / sanitize_url(url)
+
+
+class PageStore(ABC):
+    """Crawl cache: extracted pages keyed by URL, with their fetch metadata.
+
+    A record is a dict with `url`, `text`, `html_text`, `links` and the
+    validators used for conditional re-fetching: `etag`, `last_modified`
+    and `fetched_at` (a Unix timestamp).
+    """
+
+    @abstractmethod
+    def get_many(self, urls):
+        """Records of the `urls` present in the store, as a dict keyed by URL"""
+
+    @abstractmethod
+    def put_many(self, records):
+        """Insert or replace records"""
+
+    @abstractmethod
+    def delete_many(self, urls):
+        """Remove the records of `urls`, e.g. pages that answered 404"""
+
+    def close(self):
+        pass
+
+
+class SQLitePageStore(PageStore):
+    """All pages of a site in one SQLite file, compressed with zstd (zlib without zstandard).
+
+    Writes are batched into one transaction. Other workers can read while a
+    batch is being written (WAL mode). A writer waits at most `lock_timeout`
+    seconds for the database lock, then raises. Pages that are missing here
+    but exist in the old per-page json.gz layout are read from it once and
+    copied in.
+    """
+
+    def __init__(self, path, lock_timeout=30.0, level=3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.codec = "zstd" if zstandard is not None else "zlib"
+        self.level = level
+        self._lock = threading.Lock()  # One connection shared by the executor threads
+        self._db = sqlite3.connect(self.path, timeout=lock_timeout, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, codec TEXT NOT NULL, body BLOB NOT NULL, "
+            "etag TEXT, last_modified TEXT, fetched_at REAL)"
+        )
+        self._db.commit()
+        self._legacy = JsonGzPageStore()
+
+    def _compress(self, data):
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return zlib.compress(data, self.level)
+
+    @staticmethod
+    def _decompress(codec, body):
+        if codec == "zstd":
+            return zstandard.ZstdDecompressor().decompress(body)
+        return zlib.decompress(body)
+
+    def get_many(self, urls):
+        urls = list(dict.fromkeys(urls))
+        records = {}
+        with self._lock:
+            for start in range(0, len(urls), 500):  # Stay below SQLite's variable limit
+                batch = urls[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT url, codec, body, etag, last_modified, fetched_at FROM pages "
+                    f"WHERE url IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for url, codec, body, etag, last_modified, fetched_at in rows:
+                    record = json.loads(self._decompress(codec, body))
+                    record.update(url=url, etag=etag, last_modified=last_modified, fetched_at=fetched_at)
+                    records[url] = record
+        legacy = self._legacy.get_many([url for url in urls if url not in records])
+        if legacy:
+            self.put_many(legacy.values())
+            records.update(legacy)
+        return records
+
+    def urls(self):
+        """URLs of every page in the store"""
+        with self._lock:
+            return [url for url, in self._db.execute("SELECT url FROM pages")]
+
+    def put_many(self, records):
+        rows = []
+        for record in records:
+            body = json.dumps({key: record.get(key) for key in ("text", "html_text", "links")})
+            rows.append((record["url"], self.codec, self._compress(body.encode("utf-8")),
+                         record.get("etag"), record.get("last_modified"), record.get("fetched_at")))
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_many(self, urls):
+        urls = list(urls)
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM pages WHERE url = ?", [(url,) for url in urls])
+        self._legacy.delete_many(urls)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JsonGzPageStore(PageStore):
+    """The original layout: one gzip'd JSON file per page under the page's own site directory.
+
+    Writers take an flock on a lock file next to the page, giving up after
+    `lock_timeout` seconds instead of spinning on a stale O_EXCL lock file.
+    """
+
+    def __init__(self, lock_timeout=30.0):
+        self.lock_timeout = lock_timeout
+
+    @staticmethod
+    def path(url):
+        hashed = hashlib.sha256(url.encode()).hexdigest()
+        return _site_dir(url) / f"{hashed}.json.gz"
+
+    def get_many(self, urls):
+        records = {}
+        for url in urls:
+            path = self.path(url)
+            if not path.exists():
+                continue
+            record = json.loads(gzip_decompress(path.read_bytes()).decode("utf-8"))
+            record.setdefault("fetched_at", os.path.getmtime(path))
+            record["url"] = url
+            records[url] = record
+        return records
+
+    def put_many(self, records):
+        for record in records:
+            path = self.path(record["url"])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = gzip_compress(json.dumps(record).encode("utf-8"))
+            with open(path.with_suffix(".lock"), "w") as lock_file:
+                deadline = time.monotonic() + self.lock_timeout
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f"Timed out waiting for the lock on {path}")
+                        time.sleep(0.05)
+                tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+
+    def delete_many(self, urls):
+        for url in urls:
+            self.path(url).unlink(missing_ok=True)
+
+
+def open_page_store(url, kind=None):
+    """Page store for the site crawled from `url`; PAGE_STORE selects "sqlite" (default) or "json"."""
+    kind = kind or os.getenv("PAGE_STORE", "sqlite")
+    lock_timeout = float(os.getenv("PAGE_STORE_LOCK_TIMEOUT", "30"))
+    if kind == "json":
+        return JsonGzPageStore(lock_timeout)
+    if kind == "sqlite":
+        return SQLitePageStore(_site_dir(url) / "pages.sqlite", lock_timeout)
+    raise ValueError(f"Unknown page store {kind!r}, expected 'sqlite' or 'json'")
@@ -0,0 +1,112 @@
+import asyncio
+import numpy as np
+
+
+class _PendingQuery:
+    def __init__(self, embedding_manager, query, k, query_vector, search):
+        self.embedding_manager = embedding_manager
+        self.query = query
+        self.k = k
+        self.query_vector = query_vector
+        self.search = search  # False: only the embedding is wanted
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class QueryBatcher:
+    """Coalesces queries arriving within `window` seconds into batched work.
+
+    All pending queries of the same embedding model are encoded with one
+    `generate_embeddings` call, then every index is searched once with the
+    matrix of its queries. Results come back through per-request futures.
+    Under a single user nothing waits longer than `window`. Under concurrent
+    load the transformer and FAISS overhead is shared across the batch.
+    """
+
+    def __init__(self, window=0.005, max_batch=64, executor=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor
+        self._pending = []
+        self._flush_task = None
+        self._full = None  # Set when the pending batch reaches max_batch
+        self.batches = 0
+        self.queries = 0
+
+    async def embed(self, embedding_manager, query):
+        """Embedding of `query`, computed together with other pending queries"""
+        return await self._submit(_PendingQuery(embedding_manager, query, 0, None, search=False))
+
+    async def search(self, embedding_manager, query, k=3, query_vector=None):
+        """(similarities, chunks, sources) of `query` as single rows, like `search_index_with_sources`"""
+        return await self._submit(_PendingQuery(embedding_manager, query, k, query_vector, search=True))
+
+    async def _submit(self, pending):
+        self._pending.append(pending)
+        if self._flush_task is None:
+            self._full = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush())
+        elif len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await pending.future
+
+    async def _flush(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+        batch, self._pending = self._pending, []
+        self._flush_task = None
+        self.batches += 1
+        self.queries += len(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self._run_batch, batch)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    @staticmethod
+    def _run_batch(batch):
+        # One forward pass per embedding model for every query that needs a vector
+        by_model = {}
+        for pending in batch:
+            if pending.query_vector is None:
+                by_model.setdefault(pending.embedding_manager.model_name, []).append(pending)
+        for group in by_model.values():
+            vectors = group[0].embedding_manager.generate_embeddings([pending.query for pending in group])
+            for pending, vector in zip(group, vectors):
+                pending.query_vector = vector
+
+        # One search per index
+        results = {}
+        by_index = {}
+        for pending in batch:
+            if pending.search:
+                by_index.setdefault(id(pending.embedding_manager), []).append(pending)
+            else:
+                results[id(pending)] = pending.query_vector
+        for group in by_index.values():
+            k = max(pending.k for pending in group)
+            vectors = np.vstack([np.asarray(p.query_vector, dtype=np.float32).reshape(1, -1) for p in group])
+            similarities, chunks, sources = group[0].embedding_manager.search_index_with_sources(
+                [pending.query for pending in group], k, vectors
+            )
+            for row, pending in enumerate(group):
+                results[id(pending)] = (
+                    similarities[row:row + 1, :pending.k],
+                    chunks[row:row + 1, :pending.k],
+                    sources[row:row + 1, :pending.k],
+                )
+        return [results[id(pending)] for pending in batch]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+        }
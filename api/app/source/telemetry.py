@@ -0,0 +1,323 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labels, key)))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                labels = dict(zip(self.labels, key))
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Counters and histograms of this process, rendered in the Prometheus text format.
+
+    Collectors are callables run at scrape time that return `(name, labels,
+    value)` gauges, so state that already lives in `stats()` methods (queue
+    depths, cache hit counts...) is read when scraped instead of duplicated.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        declared = set()
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                if name not in declared:
+                    lines.append(f"# TYPE {name} gauge")
+                    declared.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def stats_gauges(prefix, stats, labels=None):
+    """Numeric fields of a `stats()` dict as gauges; nested dicts extend the name, lists of dicts get an `item` label"""
+    labels = labels or {}
+    for key, value in stats.items():
+        name = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(key))}"
+        if isinstance(value, (bool, int, float)):
+            yield name, labels, value
+        elif isinstance(value, dict):
+            yield from stats_gauges(name, value, labels)
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                if isinstance(item, dict):
+                    yield from stats_gauges(name, item, {**labels, "item": i})
+
+
+metrics_registry = MetricsRegistry()
+
+SPAN_SECONDS = metrics_registry.histogram("rag_span_seconds", "Duration of traced operations", ("span",))
+HTTP_SECONDS = metrics_registry.histogram(
+    "rag_http_request_seconds", "HTTP request duration, including streamed bodies", ("path", "status")
+)
+PROMPT_TOKENS = metrics_registry.counter("rag_llm_prompt_tokens_total", "Prompt tokens sent to the LLM")
+COMPLETION_TOKENS = metrics_registry.counter("rag_llm_completion_tokens_total", "Tokens generated by the LLM")
+TOKENS_PER_SECOND = metrics_registry.histogram(
+    "rag_llm_tokens_per_second", "Generated tokens per second of completion time",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+TTFT_SECONDS = metrics_registry.histogram("rag_llm_ttft_seconds", "Time to first streamed token, retrieval included")
+QUEUE_WAIT_SECONDS = metrics_registry.histogram("rag_pool_queue_wait_seconds", "Time spent waiting for a model lease")
+EMBEDDED_TEXTS = metrics_registry.counter("rag_embedded_texts_total", "Texts encoded by the embedding model")
+EMBEDDING_CACHE_LOOKUPS = metrics_registry.counter(
+    "rag_embedding_cache_lookups_total", "Embedding cache lookups", ("result",)
+)
+EXECUTOR_WAIT_SECONDS = metrics_registry.histogram(
+    "rag_executor_queue_wait_seconds", "Time tasks wait for an executor thread", ("executor",)
+)
+
+
+def record_generation(prompt_tokens, completion_tokens, seconds):
+    PROMPT_TOKENS.inc(prompt_tokens)
+    COMPLETION_TOKENS.inc(completion_tokens)
+    if completion_tokens and seconds > 0:
+        TOKENS_PER_SECOND.observe(completion_tokens / seconds)
+
+
+trace_logger = logging.getLogger("rag.trace")
+_current_span = contextvars.ContextVar("current_span", default=None)  # (trace ID, span ID)
+
+
+def configure_trace_log(target):
+    """Write one JSON line per finished span to stderr ("stderr" or "1") or to the file `target`"""
+    if not target:
+        return
+    handler = logging.StreamHandler() if target in ("1", "stderr") else logging.FileHandler(target)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+def current_trace_id():
+    current = _current_span.get()
+    return current[0] if current else None
+
+
+def _finish_span(name, trace_id, span_id, parent_id, start, duration, error, attributes):
+    SPAN_SECONDS.observe(duration, span=name)
+    if trace_logger.isEnabledFor(logging.INFO):
+        trace_logger.info(json.dumps({
+            "trace": trace_id,
+            "span": span_id,
+            "parent": parent_id,
+            "name": name,
+            "start": start,
+            "duration_ms": round(duration * 1000, 3),
+            "error": error,
+            **attributes,
+        }, default=str))
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the block as span `name`; spans opened inside it (also in executor threads) become its children.
+
+    Yields the attribute dict, so the block can add to what goes in the trace log.
+    """
+    parent = _current_span.get()
+    trace_id = parent[0] if parent else os.urandom(8).hex()
+    span_id = os.urandom(8).hex()
+    token = _current_span.set((trace_id, span_id))
+    start = time.time()
+    start_time = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish_span(name, trace_id, span_id, parent[1] if parent else None, start,
+                     time.perf_counter() - start_time, error, attributes)
+
+
+def record_span(name, duration, error=None, **attributes):
+    """Record a span timed by the caller, for work that cannot sit in one `with` block (e.g. a generator)"""
+    parent = _current_span.get()
+    _finish_span(name, parent[0] if parent else os.urandom(8).hex(), os.urandom(8).hex(),
+                 parent[1] if parent else None, time.time() - duration, duration, error, attributes)
+
+
+def traced(name):
+    """Decorator running a function or coroutine function inside `span(name)`"""
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+_executors = weakref.WeakSet()
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that counts queued and running tasks and times how long tasks wait.
+
+    Tasks run in a copy of the submitter's context, so spans opened in the
+    thread join the trace of the request that scheduled them.
+    """
+
+    def __init__(self, name, max_workers=None, thread_name_prefix=""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix or name)
+        self.name = name
+        self.queued = 0
+        self.running = 0
+        self._counts_lock = threading.Lock()
+        _executors.add(self)
+
+    def submit(self, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+        with self._counts_lock:
+            self.queued += 1
+
+        def run():
+            EXECUTOR_WAIT_SECONDS.observe(time.perf_counter() - submitted, executor=self.name)
+            with self._counts_lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                with self._counts_lock:
+                    self.running -= 1
+
+        return super().submit(run)
+
+    def stats(self):
+        return {"workers": self._max_workers, "running": self.running, "queued": self.queued}
+
+
+def _executor_gauges():
+    for executor in list(_executors):
+        yield from stats_gauges("rag_executor", executor.stats(), {"executor": executor.name})
+
+
+metrics_registry.register_collector(_executor_gauges)
+
+
+class TracingMiddleware:
+    """ASGI middleware opening the root span of each HTTP request and returning its ID as X-Trace-Id"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = [*message.get("headers", []),
+                                      (b"x-trace-id", current_trace_id().encode())]
+            await send(message)
+
+        start_time = time.perf_counter()
+        with span("http", method=scope["method"], path=scope["path"]) as attributes:
+            try:
+                await self.app(scope, receive, send_with_trace_id)
+            finally:
+                attributes["status"] = status["code"]
+                # Unknown paths share one series so scanners cannot blow up the label set
+                path = scope["path"] if status["code"] != 404 else "other"
+                HTTP_SECONDS.observe(time.perf_counter() - start_time, path=path, status=status["code"])
@@ -0,0 +1,68 @@
+"""Recall and latency of the approximate FAISS index types against the exact flat index.
+
+Usage (from the api/ directory):
+    python benchmarks/ann_benchmark.py [--vectors 100000] [--dimension 768] [--queries 500] [--k 5]
+
+Vectors are random, normalized and clustered, so they roughly look like
+sentence embeddings. Each index type reports build time, recall@k against
+flat search, query latency and memory per vector.
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from source.indexing.index_factory import INDEX_TYPES, build_index, bytes_per_vector, default_params
+
+
+def synthetic_embeddings(count, dimension, clusters=256, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.5 * rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    data = synthetic_embeddings(args.vectors + args.queries, args.dimension)
+    corpus, queries = data[:args.vectors], data[args.vectors:]
+
+    print(f"{args.vectors} vectors, dim {args.dimension}, {args.queries} queries, k={args.k}")
+    print(f"{'index':<10} {'build s':>8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'bytes/vec':>10}")
+    ground_truth = None
+    for index_type in INDEX_TYPES:
+        params = default_params(index_type, args.vectors, args.dimension)
+        start = time.perf_counter()
+        index = build_index(corpus, params)
+        build_seconds = time.perf_counter() - start
+
+        latencies, results = [], []
+        for query in queries:
+            start = time.perf_counter()
+            _, ids = index.search(query[None, :], args.k)
+            latencies.append(time.perf_counter() - start)
+            results.append(ids[0])
+        results = np.array(results)
+        if ground_truth is None:
+            ground_truth = results  # flat is exact and always comes first
+        recall = np.mean([len(set(found) & set(truth)) / args.k for found, truth in zip(results, ground_truth)])
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"{index_type:<10} {build_seconds:8.2f} {recall:7.3f} {statistics.median(latencies) * 1000:8.3f} "
+              f"{p95 * 1000:8.3f} {bytes_per_vector(index):10.1f}")
+
+
+if __name__ == "__main__":
+    main()
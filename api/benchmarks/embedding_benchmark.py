@@ -0,0 +1,80 @@
+"""Embedding throughput (chunks/sec) of EmbeddingManager across batch sizes.
+
+Usage (from the api/ directory):
+    python benchmarks/embedding_benchmark.py [--model all-mpnet-base-v2] [--chunks 512]
+        [--batch-sizes 8 16 32 64 128] [--threads N] [--mode threads|processes]
+
+Chunks are taken from the crawled pages in data/websites when available,
+otherwise synthetic text with a realistic spread of lengths is used.
+"""
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from source.indexing.embedder import EmbeddingManager
+from source.indexing.page_store import SQLitePageStore
+
+
+def stored_texts():
+    """Text of the crawled pages: SQLite page stores, then pages in the old json.gz layout"""
+    for path in Path("data/websites").glob("*/pages.sqlite"):
+        store = SQLitePageStore(path)
+        try:
+            for record in store.get_many(store.urls()).values():
+                yield record.get("text") or ""
+        finally:
+            store.close()
+    for path in Path("data/websites").glob("*/*.json.gz"):
+        yield json.loads(gzip.decompress(path.read_bytes())).get("text", "")
+
+
+def load_chunks(count, chunk_size=384):
+    texts = []
+    for text in stored_texts():
+        texts.extend(text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+        if len(texts) >= count:
+            return texts[:count]
+
+    random.seed(0)
+    words = "the of and a to in is was for on that with as by at from city river country people".split()
+    while len(texts) < count:
+        length = random.randint(10, 80)
+        texts.append(" ".join(random.choice(words) for _ in range(length)))
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="all-mpnet-base-v2")
+    parser.add_argument("--chunks", type=int, default=512)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32, 64, 128])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--mode", choices=["threads", "processes"], default="threads")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.chunks)
+    manager = EmbeddingManager(model_name=args.model, index_dir="/tmp/embedding_benchmark",
+                               num_threads=args.threads, parallel_mode=args.mode)
+    manager.load_or_download_model()
+    manager.generate_embeddings(chunks[:8])  # warm up
+
+    print(f"{len(chunks)} chunks, model {args.model}, mode {args.mode}, threads {manager.num_threads}")
+    try:
+        for batch_size in args.batch_sizes:
+            manager.batch_size = batch_size
+            start = time.perf_counter()
+            manager.generate_embeddings(chunks)
+            elapsed = time.perf_counter() - start
+            print(f"batch {batch_size:>4}: {len(chunks) / elapsed:8.1f} chunks/sec ({elapsed:.2f}s)")
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Per-page CPU time of the page extraction step, before and after single-parse extraction.
+
+Usage (from the api/ directory):
+    python benchmarks/extraction_benchmark.py path/to/html_corpus [--repeat 3]
+
+The corpus is a directory of saved `.html` files, e.g. pages downloaded with
+`curl -o page.html <url>`.
+"""
+import argparse
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urljoin
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from trafilatura import extract
+from source.indexing.indexing_tree import extract_info_from_html
+
+
+def legacy_extraction(download, base_url=""):
+    """Previous behaviour: two full trafilatura passes plus a regex over the HTML"""
+    html_info = extract(download, output_format="html", include_links=True, include_comments=False, include_tables=False, no_fallback=True)
+    text_info = extract(download, include_comments=False, include_tables=True, no_fallback=True)
+    pattern = r'href="(?!{}#|#)([^"]+)"'.format(re.escape(base_url))
+    links = [urljoin(base_url, link) for link in re.findall(pattern, html_info or "")]
+    return html_info, text_info, links
+
+
+def time_per_page(function, pages, repeat):
+    timings = []
+    for _ in range(repeat):
+        for page in pages:
+            start = time.process_time()
+            function(page)
+            timings.append(time.process_time() - start)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<10} mean {statistics.mean(timings) * 1000:8.2f} ms  "
+          f"p50 {statistics.median(timings) * 1000:8.2f} ms  p95 {p95 * 1000:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", type=Path, help="Directory with saved .html pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = [path.read_text(encoding="utf-8", errors="ignore") for path in sorted(args.corpus.glob("*.html"))]
+    if not pages:
+        sys.exit(f"No .html files found in {args.corpus}")
+
+    # Warm up lxml/trafilatura caches so the first page does not skew the numbers
+    legacy_extraction(pages[0])
+    extract_info_from_html(pages[0])
+
+    print(f"{len(pages)} pages x {args.repeat} runs (CPU time per page)")
+    before = time_per_page(legacy_extraction, pages, args.repeat)
+    after = time_per_page(extract_info_from_html, pages, args.repeat)
+    report("before", before)
+    report("after", after)
+    print(f"speedup    {statistics.mean(before) / statistics.mean(after):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""End-to-end throughput, latency and peak memory of crawl, chunk, embed, index, search and generate.
+
+Usage (from the api/ directory):
+    python benchmarks/pipeline_benchmark.py [--site-sizes 20 100 500] [--concurrency 1 4 16]
+        [--embedding-model stub|path/to/sentence-transformer] [--gguf path/to/model.gguf]
+        [--requests 32] [--json results.json]
+
+Runs offline. A synthetic site (a tree of pages, `--fanout` links per page) is
+served by a local HTTP server. Each site size runs in its own temporary data
+directory, so every size starts with cold caches. The stages are:
+
+    crawl   LinkTree over the site; latency from request to extracted page
+    chunk   the structure-aware Chunker over the crawled pages (tokens of the embedding model)
+    embed   EmbeddingManager.generate_embeddings, latency per batch
+    index   the IndexingManager pipeline on the stored pages (chunk, embed, FAISS, BM25)
+    search  search_index_with_sources, one query at a time
+    generate generate_response with a leased model, one question at a time
+    http    POST /ask against the FastAPI app in process, at every concurrency level
+
+With `--embedding-model stub` (the default), texts are embedded by hashing
+their terms. Without `--gguf`, a stub model stands in for llama.cpp. It
+sleeps for a fixed time per prompt byte and per generated token, so the
+generate and http stages then measure the code around the model, not the
+model itself. Peak RSS is sampled from /proc while each stage runs.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from source.indexing import embedder
+from source.indexing.embedder import EmbeddingManager
+from source.indexing.indexing_manager import IndexingManager
+from source.indexing.indexing_tree import LinkTree
+from source.indexing.lexical_index import tokenize
+from source.chatter.conversation_manager import AsyncModelManager, ConversationManager, generate_response
+
+STUB_EMBEDDING_MODEL = "hashing-stub"
+
+WORDS = ("the of and a to in is was for on that with as by at from city river country people system "
+         "network router memory storage cluster service request latency cache index query model token "
+         "page document search result server client version release update feature support").split()
+
+
+def page_depth(number, fanout):
+    depth = 0
+    while number > 0:
+        number = (number - 1) // fanout
+        depth += 1
+    return depth
+
+
+def write_site(root, pages, fanout=10, paragraphs=12, seed=0):
+    """Write pages p0..p{pages-1}.html, page n linking to pages fanout*n+1..fanout*n+fanout.
+
+    Returns the `max_depth` needed to crawl all of them from p0.
+    """
+    rng = random.Random(seed)
+    for number in range(pages):
+        topic = f"topic{number}"
+        body = [f"<h1>Page {number} about {topic}</h1>"]
+        for _ in range(paragraphs):
+            words = rng.choices(WORDS, k=rng.randint(40, 90))
+            words[rng.randrange(len(words))] = topic
+            body.append(f"<p>{' '.join(words).capitalize()}.</p>")
+        # Links sit inside prose, otherwise trafilatura drops them as navigation
+        for child in range(fanout * number + 1, min(fanout * number + fanout, pages - 1) + 1):
+            body.append(f'<p>The <a href="/p{child}.html">page about topic{child}</a> explains '
+                        f'{" ".join(rng.choices(WORDS, k=20))} in more detail.</p>')
+        (root / f"p{number}.html").write_text(
+            f"<html><head><title>Page {number}</title></head><body><article>{''.join(body)}</article></body></html>"
+        )
+    return page_depth(pages - 1, fanout) + 1
+
+
+class SiteHandler(SimpleHTTPRequestHandler):
+    """Static file handler that records when each path was requested"""
+
+    def do_GET(self):
+        self.server.requested[urlparse(self.path).path] = time.perf_counter()
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_site(root):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(SiteHandler, directory=str(root)))
+    server.requested = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/p0.html"
+
+
+class PeakRSS:
+    """Highest resident set size of the process while the `with` block runs"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # Without /proc this is the peak of the whole process so far
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+class HashingEncoder:
+    """Stand-in for a sentence transformer: normalized signed hashes of the terms of each text"""
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term in tokenize(text):
+                digest = zlib.crc32(term.encode())
+                vectors[row, digest % self.dimension] += 1.0 if digest & 0x80000000 else -1.0
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class StubEmbeddings:
+    """Has the `_client` EmbeddingManager uses from HuggingFaceEmbeddings"""
+
+    def __init__(self, dimension=384):
+        self._client = HashingEncoder(dimension)
+
+
+class StubLlama:
+    """Stand-in for llama_cpp.Llama with a byte-level tokenizer and a fixed cost per token.
+
+    One byte is one token, so `n_ctx` is four times the real 2048 tokens to
+    hold about as much text. Sleeping releases the GIL the way llama.cpp does.
+    """
+
+    def __init__(self, answer_tokens=32, token_seconds=0.005, prefill_seconds=0.00005, n_ctx=8192):
+        self.answer_tokens = answer_tokens
+        self.token_seconds = token_seconds
+        self.prefill_seconds = prefill_seconds
+        self._n_ctx = n_ctx
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return list(text)
+
+    def detokenize(self, tokens):
+        return bytes(tokens)
+
+    def _generate(self, messages, max_tokens):
+        prompt_bytes = sum(len(message["content"].encode("utf-8")) for message in messages)
+        time.sleep(prompt_bytes * self.prefill_seconds)
+        for _ in range(min(self.answer_tokens, max_tokens)):
+            time.sleep(self.token_seconds)
+            yield "x"
+
+    def create_chat_completion(self, messages, temperature=0.2, max_tokens=512, stream=False, **kwargs):
+        tokens = self._generate(messages, max_tokens)
+        if stream:
+            return ({"choices": [{"delta": {"content": token}}]} for token in tokens)
+        content = "".join(tokens)
+        prompt_tokens = sum(len(message["content"].encode("utf-8")) for message in messages)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content)},
+        }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def stage_result(stage, items, seconds, latencies, peak_rss, **extra):
+    return {
+        "stage": stage,
+        "items": items,
+        "seconds": seconds,
+        "throughput": items / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "peak_rss_mb": peak_rss / 1024 ** 2,
+        **extra,
+    }
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """Hide the progress prints of the pipeline, which would interleave with the report"""
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+async def bench_crawl(url, depth, server, workers):
+    nodes, latencies = [], []
+
+    async def on_page(node):
+        latencies.append(time.perf_counter() - server.requested[urlparse(node.url).path])
+        nodes.append(node)
+
+    tree = LinkTree(url, max_depth=depth, workers=workers, per_host_concurrency=workers,
+                    min_host_delay=0, on_page=on_page)
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        await tree.build_tree()
+        seconds = time.perf_counter() - start
+    return stage_result("crawl", len(nodes), seconds, latencies, rss.peak), nodes
+
+
+def bench_chunk(nodes, model_name, chunk_size):
+    manager = IndexingManager(nodes[0].url, model_name=model_name, chunk_size=chunk_size)
+    chunker = manager.make_chunker()
+    chunks, latencies = [], []
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        for node in nodes:
+            page_start = time.perf_counter()
+            chunks.extend(chunker.chunk_page(node)[0])
+            latencies.append(time.perf_counter() - page_start)
+        seconds = time.perf_counter() - start
+    return stage_result("chunk", len(chunks), seconds, latencies, rss.peak), chunks
+
+
+def bench_embed(model_name, chunks, batch_size):
+    manager = EmbeddingManager(model_name=model_name, index_dir="data/embedding_benchmark", cache_dir=None)
+    manager.load_or_download_model()
+    manager.generate_embeddings(chunks[:8])  # warm up
+    latencies = []
+    try:
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            for batch_start in range(0, len(chunks), batch_size):
+                batch_time = time.perf_counter()
+                manager.generate_embeddings(chunks[batch_start:batch_start + batch_size])
+                latencies.append(time.perf_counter() - batch_time)
+            seconds = time.perf_counter() - start
+    finally:
+        manager.close()
+    return stage_result("embed", len(chunks), seconds, latencies, rss.peak)
+
+
+async def bench_index(url, depth, model_name, args):
+    # Pages come from the page store filled by the crawl stage
+    manager = IndexingManager(url, model_name=model_name, chunk_size=args.chunk_size, max_depth=depth,
+                              crawl_workers=args.crawl_workers, embed_batch_size=args.batch_size)
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        await manager()
+        seconds = time.perf_counter() - start
+    return stage_result("index", manager.chunks_total, seconds, [], rss.peak), manager
+
+
+def bench_search(embedding_manager, questions, k):
+    latencies = []
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        for question in questions:
+            query_start = time.perf_counter()
+            embedding_manager.search_index_with_sources([question], k)
+            latencies.append(time.perf_counter() - query_start)
+        seconds = time.perf_counter() - start
+    return stage_result("search", len(questions), seconds, latencies, rss.peak)
+
+
+async def bench_generate(model, url, index_manager, questions):
+    conv_manager = ConversationManager(url, "benchmark")
+    conv_manager.index_manager = index_manager
+    latencies, tokens = [], 0
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        for question in questions:
+            answer_start = time.perf_counter()
+            answer = await generate_response(model, conv_manager, question, use_history=False)
+            latencies.append(time.perf_counter() - answer_start)
+            tokens += len(model.tokenize(answer.encode("utf-8"), add_bos=False))
+        seconds = time.perf_counter() - start
+    return stage_result("generate", len(questions), seconds, latencies, rss.peak,
+                        tokens_per_second=tokens / seconds if seconds else 0.0)
+
+
+async def bench_http(client, url, questions, concurrency, requests):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def ask(number):
+        nonlocal errors
+        async with semaphore:
+            request_start = time.perf_counter()
+            response = await client.post("/ask", json={
+                "url": url,
+                "query": questions[number % len(questions)],
+                "user_id": f"benchmark-{concurrency}-{number}",  # No history, so the full prompt every time
+            })
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - request_start)
+            else:
+                errors += 1
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(number) for number in range(requests)))
+        seconds = time.perf_counter() - start
+    return stage_result(f"http c={concurrency}", len(latencies), seconds, latencies, rss.peak, errors=errors)
+
+
+async def run_site(args, pages, models, workdir):
+    import httpx
+    import main as api
+
+    site_root = workdir / "site"
+    site_root.mkdir()
+    depth = write_site(site_root, pages, args.fanout)
+    server, url = serve_site(site_root)
+    results = []
+    questions = [f"What does the page say about topic{random.Random(n).randrange(pages)}?"
+                 for n in range(max(args.questions, args.requests))]
+    try:
+        with quiet(args.verbose):
+            result, nodes = await bench_crawl(url, depth, server, args.crawl_workers)
+            results.append(result)
+            result, chunks = bench_chunk(nodes, args.embedding_model, args.chunk_size)
+            results.append(result)
+            results.append(bench_embed(args.embedding_model, chunks, args.batch_size))
+            result, index_manager = await bench_index(url, depth, args.embedding_model, args)
+            results.append(result)
+            results.append(bench_search(index_manager.embedding_manager, questions[:args.questions], args.k))
+            results.append(await bench_generate(models[0], url, index_manager, questions[:args.questions]))
+
+            api.index_registry.register(index_manager)
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                for concurrency in args.concurrency:
+                    results.append(await bench_http(client, url, questions, concurrency, args.requests))
+    finally:
+        server.shutdown()
+    return depth, results
+
+
+def print_report(pages, depth, results):
+    print(f"\nsite of {pages} pages (depth {depth})")
+    print(f"{'stage':<10} {'items':>7} {'seconds':>8} {'items/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'peak RSS MB':>12}")
+    for result in results:
+        p50 = f"{result['p50_ms']:9.2f}" if result["p50_ms"] is not None else f"{'-':>9}"
+        p95 = f"{result['p95_ms']:9.2f}" if result["p95_ms"] is not None else f"{'-':>9}"
+        notes = []
+        if "tokens_per_second" in result:
+            notes.append(f"{result['tokens_per_second']:.1f} tokens/s")
+        if result.get("errors"):
+            notes.append(f"{result['errors']} errors")
+        print(f"{result['stage']:<10} {result['items']:>7} {result['seconds']:8.2f} {result['throughput']:9.1f} "
+              f"{p50} {p95} {result['peak_rss_mb']:12.1f}  {', '.join(notes)}")
+
+
+async def run(args):
+    if args.gguf:
+        manager = AsyncModelManager(str(Path(args.gguf).resolve()), n_threads=args.threads or os.cpu_count())
+        models = [await manager.load_model()]
+    else:
+        models = [StubLlama(args.stub_tokens, args.stub_token_ms / 1000, args.stub_prefill_ms / 1000)
+                  for _ in range(args.models)]
+    if args.embedding_model == STUB_EMBEDDING_MODEL:
+        embedder._loaded_models[STUB_EMBEDDING_MODEL] = StubEmbeddings()
+    elif Path(args.embedding_model).exists():
+        args.embedding_model = str(Path(args.embedding_model).resolve())  # The runs chdir to a temporary directory
+
+    # Read by main.py when it is imported
+    os.environ.setdefault("LLM_POOL_MAX_WAITERS", str(max(args.concurrency) + 1))
+    if not args.answer_cache:
+        os.environ.setdefault("ANSWER_CACHE_THRESHOLD", "2")  # Cosine similarity never reaches it
+    import main as api
+    for model in models:
+        api.model_pool.scheduler.add(model)
+    api.model_pool._started = True  # Use the models loaded here instead of the pool's own
+
+    all_results = []
+    cwd = os.getcwd()
+    for pages in args.site_sizes:
+        with tempfile.TemporaryDirectory(prefix="pipeline_benchmark_") as tmp:
+            os.chdir(tmp)
+            try:
+                depth, results = await run_site(args, pages, models, Path(tmp))
+            finally:
+                os.chdir(cwd)
+        print_report(pages, depth, results)
+        all_results.extend({"site_pages": pages, **result} for result in results)
+    api.job_manager.shutdown()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(all_results, indent=2))
+        print(f"\nResults written to {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--site-sizes", type=int, nargs="+", default=[20, 100, 500])
+    parser.add_argument("--fanout", type=int, default=10, help="Links per page")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="/ask requests per concurrency level")
+    parser.add_argument("--questions", type=int, default=16, help="Questions for the search and generate stages")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--crawl-workers", type=int, default=8)
+    parser.add_argument("--embedding-model", default=STUB_EMBEDDING_MODEL,
+                        help=f"Local sentence-transformers model, or {STUB_EMBEDDING_MODEL!r}")
+    parser.add_argument("--gguf", help="Local GGUF model; a stub model is used when omitted")
+    parser.add_argument("--threads", type=int, default=None, help="llama.cpp threads for --gguf")
+    parser.add_argument("--models", type=int, default=1, help="Stub models in the pool")
+    parser.add_argument("--stub-tokens", type=int, default=32, help="Tokens generated per stub answer")
+    parser.add_argument("--stub-token-ms", type=float, default=5.0)
+    parser.add_argument("--stub-prefill-ms", type=float, default=0.05, help="Per prompt token (byte)")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the semantic answer cache enabled")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own progress output")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
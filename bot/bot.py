@@ -1,10 +1,61 @@
 import os
+import asyncio
+import json
+import time
 import httpx
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 API_URL = os.getenv("API_URL", "http://api:8000")
+POLL_INTERVAL = float(os.getenv("INDEX_POLL_INTERVAL", "5"))
+INDEX_TIMEOUT = float(os.getenv("INDEX_TIMEOUT", "1800"))  # Give up waiting for an indexing job after this
+EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1"))  # Telegram rate-limits message edits
+
+def format_progress(job):
+    text = f"Indexing website... {job['pages_crawled']} pages crawled, {job['chunks_embedded']}/{job['chunks_total']} chunks embedded"
+    if job.get("eta_seconds") is not None:
+        text += f", ~{int(job['eta_seconds'])}s left"
+    return text
+
+async def wait_for_index(client, message, url):
+    """Poll the indexing job, editing the progress message until it finishes"""
+    last_text = None
+    deadline = time.monotonic() + INDEX_TIMEOUT
+    while True:
+        response = await client.get(f"{API_URL}/process_url/status", params={"url": url})
+        job = response.json()
+        if job["status"] in ("done", "failed", "cancelled"):
+            return job
+        if time.monotonic() > deadline:
+            return {**job, "status": "failed", "error": f"still {job['status']} after {int(INDEX_TIMEOUT)}s"}
+        text = format_progress(job)
+        if text != last_text:
+            await message.edit_text(text)
+            last_text = text
+        await asyncio.sleep(POLL_INTERVAL)
+
+async def stream_answer(client, message, payload):
+    """Stream the answer from the API, editing `message` as tokens arrive"""
+    answer = ""
+    shown = ""
+    last_edit = time.monotonic()
+    async with client.stream("POST", f"{API_URL}/ask", json={**payload, "stream": True}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            answer += event.get("token", "")
+            if answer.strip() and answer != shown and time.monotonic() - last_edit >= EDIT_INTERVAL:
+                await message.edit_text(answer)
+                shown = answer
+                last_edit = time.monotonic()
+    if answer.strip() and answer != shown:
+        await message.edit_text(answer)
+    return answer
 
 async def start(update: Update, context):
     await update.message.reply_text("Send me a website URL to index first!")
@@ -16,13 +67,18 @@ async def handle_message(update: Update, context):
     try:
         if text.startswith("/process_url"):
             url = text[len("/process_url"):].strip()
-            async with httpx.AsyncClient(timeout = 240) as client:
-                await update.message.reply_text("Indexing website...")
-                # Send as JSON body with "url" key
+            async with httpx.AsyncClient(timeout = 30) as client:
+                progress_message = await update.message.reply_text("Indexing website...")
+                # Send as JSON body with "url" key; indexing continues in the background
                 response = await client.post(
                     f"{API_URL}/process_url",
                     json={"url": url}  # Wrap in JSON object
                 )
+                response.raise_for_status()
+                job = await wait_for_index(client, progress_message, url)
+            if job["status"] != "done":
+                await update.message.reply_text(f"Indexing failed: {job.get('error')}")
+                return
             await update.message.reply_text("Indexing finished! Now ask questions")
             context.user_data["current_url"] = url
         else:
@@ -32,17 +88,13 @@ async def handle_message(update: Update, context):
                 return
                 
             async with httpx.AsyncClient(timeout = 300) as client:
-                await update.message.reply_text("Processing query...")
-                # Send all parameters in JSON body
-                response = await client.post(
-                    f"{API_URL}/ask",
-                    json={
-                        "url": url,
-                        "query": text,
-                        "user_id": str(user_id)
-                    }
-                )
-                await update.message.reply_text(response.json()["response"])
+                answer_message = await update.message.reply_text("Processing query...")
+                # Send all parameters in JSON body; the answer is edited in as it is generated
+                await stream_answer(client, answer_message, {
+                    "url": url,
+                    "query": text,
+                    "user_id": str(user_id)
+                })
     except Exception as e:
         await update.message.reply_text(f"Error: {str(e)}")
 